@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+# -*- coding: us-ascii -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+#
+"""Catalog directories of HanDBase PDB files into a single SQLite3 database.
+
+Walks directory trees, extracts table name, column metadata, record count
+and file stats using a pool of processes. Files whose size and mtime
+are unchanged since the last scan are skipped.
+
+Example:
+
+    catalog.py -c catalog.sqlite3 /archive/pdbs
+    catalog.py -c catalog.sqlite3 --field "%price%"  # which archives have a field like "price"?
+    sqlite3 catalog.sqlite3 "select path from pdb_columns where column_name = 'Price'"
+"""
+
+import json
+import multiprocessing
+import os
+import sqlite3
+import sys
+
+from cli import MyOptionParser
+import handbase_format
+
+
+__version__ = '0.0.0'
+
+PDB_EXTENSION = '.PDB'
+PDB_TYPE = PDB_CREATOR = 'HanD'  # other Palm OS databases (e.g. MemoDB) are recorded as errors
+read_head_size = 64 * 1024  # metadata lives near the start of the file, no need to read records
+
+catalog_ddl = '''
+CREATE TABLE IF NOT EXISTS pdb_files (
+    path TEXT PRIMARY KEY,
+    size INTEGER,
+    mtime REAL,
+    table_name TEXT,
+    record_count INTEGER,
+    created TEXT,
+    modified TEXT,
+    error TEXT
+);
+CREATE TABLE IF NOT EXISTS pdb_columns (
+    path TEXT,
+    column_number INTEGER,
+    column_name TEXT,
+    datatype INTEGER,
+    datatype_text TEXT,
+    length INTEGER
+);
+CREATE INDEX IF NOT EXISTS pdb_columns_path ON pdb_columns (path);
+CREATE INDEX IF NOT EXISTS pdb_columns_name ON pdb_columns (column_name COLLATE NOCASE);
+'''
+
+
+def find_pdb_files(directories):
+    """Generator, returns (path, size, mtime) for all PDB files under directories
+    """
+    for directory in directories:
+        for dirpath, dirnames, filenames in os.walk(directory):
+            for filename in filenames:
+                if filename.upper().endswith(PDB_EXTENSION):
+                    path = os.path.abspath(os.path.join(dirpath, filename))
+                    stat_info = os.stat(path)
+                    yield path, stat_info.st_size, stat_info.st_mtime
+
+
+def scan_pdb_file(path):
+    """Returns tuple of (path, file_details_dict, columns_list)
+    Errors are returned (as text) in file_details_dict['error'] rather than raised,
+    so one bad file does not stop a scan.
+    Only the head of the file is read, up to the end of the field/column segments.
+    """
+    details = {'table_name': None, 'record_count': None, 'created': None, 'modified': None, 'error': None}
+    columns = []
+    try:
+        f = open(path, 'rb')
+        try:
+            data = f.read(read_head_size)
+            header = handbase_format.extract_pdb_header(data)
+            details['record_count'] = header['record_count']
+            for key in ('created', 'modified'):
+                if header[key]:
+                    details[key] = header[key].isoformat()
+            if header['type'] != PDB_TYPE or header['creator'] != PDB_CREATOR:
+                raise ValueError('not a HanDBase PDB, type %r creator %r' % (header['type'], header['creator']))
+            marker = data.find(b'HanDB')
+            if marker == -1:
+                data += f.read()
+                marker = data.find(b'HanDB')
+                if marker == -1:
+                    raise ValueError('no HanDB marker')
+            segments_end = marker + handbase_format.metadata_segment_offset + handbase_format.MAX_FIELDS * handbase_format.metadata_segment_length
+            if len(data) < segments_end:
+                data += f.read(segments_end - len(data))
+        finally:
+            f.close()
+        metadata = handbase_format.extract_metadata(data, include_unused=False, include_heading=False)
+        details['table_name'] = metadata['table_name']
+        for column_number, column in enumerate(metadata['columns'], 1):
+            column_name, column_datatype, column_datatype_text, column_length = column
+            columns.append((column_number, column_name, column_datatype, column_datatype_text, column_length))
+    except Exception as info:
+        details['error'] = repr(info)
+    return path, details, columns
+
+
+def update_catalog(catalog_filename, directories, num_workers=None, verbose=False):
+    """Scan directories for PDB files, and update catalog (SQLite3 database)
+    Returns tuple of (scanned_count, unchanged_count, removed_count)
+    """
+    con = sqlite3.connect(catalog_filename)
+    try:
+        cur = con.cursor()
+        cur.executescript(catalog_ddl)
+        cur.execute('SELECT path, size, mtime FROM pdb_files')
+        known = dict((path, (size, mtime)) for path, size, mtime in cur.fetchall())
+
+        to_scan = []
+        file_stats = {}
+        unchanged_count = 0
+        for path, size, mtime in find_pdb_files(directories):
+            file_stats[path] = (size, mtime)
+            if known.get(path) == (size, mtime):
+                unchanged_count += 1
+            else:
+                to_scan.append(path)
+
+        # files that have gone away, only for the directories being scanned
+        scanned_roots = [os.path.join(os.path.abspath(directory), '') for directory in directories]
+        removed = [path for path in known if path not in file_stats and any(path.startswith(root) for root in scanned_roots)]
+        for path in removed:
+            cur.execute('DELETE FROM pdb_columns WHERE path = ?', (path,))
+            cur.execute('DELETE FROM pdb_files WHERE path = ?', (path,))
+
+        if to_scan:
+            pool = multiprocessing.Pool(num_workers)
+            try:
+                for path, details, columns in pool.imap_unordered(scan_pdb_file, to_scan, chunksize=16):
+                    if verbose:
+                        print('%s %s' % (path, details['error'] or details['table_name']))
+                    size, mtime = file_stats[path]
+                    cur.execute('DELETE FROM pdb_columns WHERE path = ?', (path,))
+                    cur.execute('INSERT OR REPLACE INTO pdb_files (path, size, mtime, table_name, record_count, created, modified, error) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                                (path, size, mtime, details['table_name'], details['record_count'], details['created'], details['modified'], details['error']))
+                    cur.executemany('INSERT INTO pdb_columns (path, column_number, column_name, datatype, datatype_text, length) VALUES (?, ?, ?, ?, ?, ?)',
+                                    [(path,) + column for column in columns])
+            finally:
+                pool.close()
+                pool.join()
+        cur.close()
+        con.commit()
+    finally:
+        con.close()
+    return len(to_scan), unchanged_count, len(removed)
+
+
+def find_field(catalog_filename, field_name):
+    """Returns list of (path, table_name, column_name, datatype_text) for columns like field_name, case insensitive.
+    field_name may contain SQL LIKE wildcards.
+    """
+    con = sqlite3.connect(catalog_filename)
+    try:
+        cur = con.cursor()
+        cur.execute('''SELECT f.path, f.table_name, c.column_name, c.datatype_text
+            FROM pdb_columns c JOIN pdb_files f ON f.path = c.path
+            WHERE c.column_name LIKE ?
+            ORDER BY f.path, c.column_number''', (field_name,))
+        result = cur.fetchall()
+        cur.close()
+    finally:
+        con.close()
+    return result
+
+
+def catalog_to_dict(catalog_filename):
+    """Returns catalog as a list of dictionaries, suitable for JSON
+    """
+    con = sqlite3.connect(catalog_filename)
+    try:
+        cur = con.cursor()
+        cur.execute('SELECT path, size, mtime, table_name, record_count, created, modified, error FROM pdb_files ORDER BY path')
+        column_names = [x[0] for x in cur.description]
+        result = [dict(zip(column_names, row)) for row in cur.fetchall()]
+        for entry in result:
+            cur.execute('SELECT column_name, datatype, datatype_text, length FROM pdb_columns WHERE path = ? ORDER BY column_number', (entry['path'],))
+            entry['columns'] = cur.fetchall()
+        cur.close()
+    finally:
+        con.close()
+    return result
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+
+    usage = "usage: %prog [options] [directory ...]"
+    description = '''Catalog directories of HanDBase PDB files'''
+    example_usage = '''
+Examples:
+
+    %prog -c catalog.sqlite3 /archive/pdbs  # scan (only new/changed files are read)
+    %prog -c catalog.sqlite3 --field "%price%"  # find databases with a field
+    %prog -c catalog.sqlite3 --json > catalog.json
+'''
+    parser = MyOptionParser(usage=usage, version="%%prog %s" % __version__, description=description, epilog=example_usage)
+    parser.add_option("-c", "--catalog", help="Catalog (SQLite3) filename, default %default", default='handbase_catalog.sqlite3')
+    parser.add_option("-j", "--jobs", help="Number of processes, defaults to number of CPUs", type="int")
+    parser.add_option("--field", help="Find field/column name, case insensitive, SQL LIKE wildcards")
+    parser.add_option("--json", help="Dump catalog as JSON to stdout", action="store_true")
+    parser.add_option("-v", "--verbose", help='Verbose', action="store_true")
+
+    (options, args) = parser.parse_args(argv[1:])
+    if not (args or options.field or options.json):
+        parser.print_help()
+        print('\n MISSING directory name')  # stderr?
+        return 1
+
+    if args:
+        scanned_count, unchanged_count, removed_count = update_catalog(options.catalog, args, num_workers=options.jobs, verbose=options.verbose)
+        print('scanned: %d unchanged: %d removed: %d' % (scanned_count, unchanged_count, removed_count))
+
+    if options.field:
+        for row in find_field(options.catalog, options.field):
+            print('\t'.join(['%s' % x for x in row]))
+
+    if options.json:
+        print(json.dumps(catalog_to_dict(options.catalog), indent=4))
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
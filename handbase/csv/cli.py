@@ -0,0 +1,14 @@
+#!/usr/bin/env python
+# -*- coding: us-ascii -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+#
+"""Command line helpers shared by the scripts in handbase/csv and handbase/web
+"""
+
+from optparse import OptionParser
+
+
+class MyOptionParser(OptionParser):
+    def format_epilog(self, formatter):
+        # preserve newlines
+        return self.expand_prog_name(self.epilog)
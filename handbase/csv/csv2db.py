@@ -6,12 +6,17 @@
 
 """
 
-import codecs  # pre Python 3 support
-import csv
-from optparse import OptionParser
+import json
 import os
 import sqlite3
 import sys
+import threading
+
+try:
+    import queue
+except ImportError:
+    # Py2
+    import Queue as queue
 
 try:
     #raise ImportError  # DEBUG force pypyodbc usage
@@ -23,6 +28,7 @@ except ImportError:
     except ImportError:
         pyodbc = None
 
+from cli import MyOptionParser
 import handbase_format
 from db2csv import con2driver
 
@@ -32,6 +38,39 @@ is_py3 = sys.version_info >= (3,)
 __version__ = '0.0.0'
 
 
+LOAD_TABLE = 'table'
+LOAD_ROWS = 'rows'
+LOAD_DONE = 'done'
+LOAD_ERROR = 'error'
+LOAD_WORKER_EXIT = 'worker_exit'
+
+STAGING_TABLE_PREFIX = handbase_format.INTERNAL_TABLE_PREFIX + 'loading_'  # load_streams() loads into this, then renames
+
+
+def staging_ddl(ddl_sql, table_name, staging_table_name):
+    """Returns ddl_sql (CREATE TABLE for table_name) creating staging_table_name instead"""
+    for create_table in ('CREATE TABLE "%s"', 'CREATE TABLE IF NOT EXISTS "%s"'):
+        if ddl_sql.startswith(create_table % table_name):
+            return create_table % staging_table_name + ddl_sql[len(create_table % table_name):]
+    raise ValueError('ddl_sql does not create table %r: %r' % (table_name, ddl_sql[:80]))
+
+
+def header_to_sql(header, table_name, param_marker='?', ddl_sql=None, dml_sql=None):
+    """Returns tuple of (ddl_sql, dml_sql) for CSV header (list of column names).
+    Only generates statements not passed in.
+    """
+    if ddl_sql is None:
+        # Assume SQLite3 syntax
+        column_ddl = ', '.join(['"%s" STRING' % column_name for column_name in header])
+        ddl_sql = 'CREATE TABLE IF NOT EXISTS "%s" (%s)' % (table_name, column_ddl)  # if table exists, assume correct column names (and we ignore types...)
+    if dml_sql is None:
+        qmark_bind_markers = ', '.join([param_marker for dummy_values in range(len(header))])
+        column_names = ', '.join(['"%s"' % column_name for column_name in header])
+        # assume/use delimited indentifiers
+        dml_sql = 'INSERT INTO "%s" (%s) VALUES (%s)' % (table_name, column_names, qmark_bind_markers)  # this is essentially a sanity check on the names
+    return ddl_sql, dml_sql
+
+
 def dump_csv_to_db(csv_filename, connection_string, table_name, param_marker='?', db_driver=None, ddl_sql=None, dml_sql=None, encoding='cp1252', metadata=None):
     """Open's named CSV file and uses header as column names.
     Assumes string type for all columns.
@@ -47,71 +86,31 @@ def dump_csv_to_db(csv_filename, connection_string, table_name, param_marker='?'
     #encoding = "latin1"
     #encoding = "cp1252"
     #encoding = "utf-8"  # FIXME - I'm injecting utf8 into HanDBase BUT it does not understand it, it treats it like latin-1/15
-    if is_py3:
-        fh = codecs.open(csv_filename, 'rb', encoding=encoding)
-    else:
-        fh = open(csv_filename, 'rb')
+    fh = open(csv_filename, 'rb')
 
     try:
-        in_csv = csv.reader(fh)
+        in_csv = handbase_format.csv_reader(fh, encoding=encoding)
         #import pdb ; pdb.set_trace()
         header = next(in_csv)
-        if not is_py3:
-            header = [x.decode(encoding) for x in header]
-        num_cols = len(header)
         print(header)
         print('*'*65)
-        if ddl_sql is None:
-            # Assume SQLite3 syntax
-            column_ddl = ', '.join(['"%s" STRING' % column_name for column_name in header])
-            print(column_ddl)
-            ddl_sql = 'CREATE TABLE IF NOT EXISTS %s (%s)' % (table_name, column_ddl)  # if table exists, assume correct column names (and we ignore types...)
+        ddl_sql, dml_sql = header_to_sql(header, table_name, param_marker=param_marker, ddl_sql=ddl_sql, dml_sql=dml_sql)
         print(ddl_sql)
-        if dml_sql is None:
-            qmark_bind_markers = ', '.join([param_marker for dummy_values in range(num_cols)])
-            column_names = ', '.join(['"%s"' % column_name for column_name in header])
-            # assume/use delimited indentifiers
-            dml_sql = 'INSERT INTO "%s" (%s) VALUES (%s)' % (table_name, column_names, qmark_bind_markers)  # this is essentially a sanity check on the names
         print(dml_sql)
 
         con = db_driver.connect(connection_string)
         cur = con.cursor()
         cur.execute(ddl_sql)
 
+        convert_row = handbase_format.build_row_converter(metadata, sql=True)
         for row_count, row in enumerate(in_csv):
             print('row %d' % row_count)  # TODO verbose logging option
-            if not is_py3:
-                row = [x.decode(encoding) for x in row]
             #print(repr(row))
             """
             if row[0].startswith('Power drift'):
                 import pdb ; pdb.set_trace()
             """
-            processed_row = []
-            for column_count, column in enumerate(row):
-                if column:
-                    if metadata:
-                        column_name, column_datatype, column_datatype_text, column_length = metadata['columns'][column_count]
-                        #sys.stdout.write('%r ' % (metadata['columns'][column_count], ))
-                        #sys.stdout.write('%r ' % ((column_name, column_datatype, column_datatype_text),))
-                        if handbase_format.HANDBASE_TYPE_TIME == column_datatype_text:
-                            if column = 'No Time':
-                                column = None
-                        elif handbase_format.HANDBASE_TYPE_DATE == column_datatype_text:
-                            if column = 'No Date':
-                                column = None
-                            else:
-                                #sys.stdout.write('%s ' % column)
-                                date_month, date_day, date_year = column.split('/')
-                                column = '%s-%s-%s' % (date_year, date_month, date_day, )
-                        elif column = 'No Value':  # TODO restrict further?
-                            column = None
-                    elif column in ('No Date', 'No Time', 'No Value'):
-                        # no metadata so we assume this is a date/time column
-                        column = None
-                #sys.stdout.write('%d ' % column_count)
-                processed_row.append(column)
-            cur.execute(dml_sql, tuple(processed_row))
+            cur.execute(dml_sql, tuple(convert_row(row)))
         cur.close()
         con.commit()
         con.close()
@@ -120,10 +119,204 @@ def dump_csv_to_db(csv_filename, connection_string, table_name, param_marker='?'
         fh.close()
 
 
-class MyOptionParser(OptionParser):  # FIXME dupe
-    def format_epilog(self, formatter):
-        # preserve newlines
-        return self.expand_prog_name(self.epilog)
+def csv_to_ndjson(csv_filename, out_file, metadata=None, encoding='cp1252', batch_size=1000):
+    """Stream CSV file to text file-like object out_file as newline delimited JSON,
+    typed using metadata if available, see handbase_format.build_row_converter().
+    Returns number of rows written.
+    """
+    fh = open(csv_filename, 'rb')
+    try:
+        in_csv = handbase_format.csv_reader(fh, encoding=encoding)
+        header = next(in_csv)
+        if metadata and len(metadata['columns']) != len(header):
+            raise ValueError('PDB has %d columns, CSV has %d' % (len(metadata['columns']), len(header)))
+        convert_row = handbase_format.build_row_converter(metadata)
+        return handbase_format.write_ndjson(out_file, header, (convert_row(row) for row in in_csv), batch_size=batch_size)
+    finally:
+        fh.close()
+
+
+def create_fts_index(connection_string, table_name, metadata, db_driver=None):
+    """Create (SQLite3 FTS5) full text index over Text and Note columns of an existing table.
+    Index is (re)built from the existing rows, triggers keep it in sync afterwards.
+    load_streams() keeps the triggers and rebuilds the index when it replaces the table.
+    Returns name of full text table, or None if there are no Text/Note columns.
+    """
+    fts_ddl = handbase_format.meta2sql_fts_ddl(metadata, table_name=table_name)
+    if fts_ddl is None:
+        return None
+    fts_name = table_name + handbase_format.fts_table_suffix
+    db_driver = db_driver or con2driver(connection_string)
+    con = db_driver.connect(connection_string)
+    try:
+        cur = con.cursor()
+        cur.executescript(fts_ddl)
+        # always, so running again repairs an index that is out of step with the table
+        cur.execute('INSERT INTO "%s" ("%s") VALUES (\'rebuild\')' % (fts_name, fts_name))
+        cur.close()
+        con.commit()
+    finally:
+        con.close()
+    return fts_name
+
+
+def create_calculated_view(connection_string, table_name, metadata, expressions=None, db_driver=None):
+    """Create (or replace) view over an existing table with Calculated and Conditional
+    columns computed by the database, see handbase_format.meta2sql_view().
+    Returns name of the view, or None if there is nothing to compute.
+    """
+    view_sql = handbase_format.meta2sql_view(metadata, expressions=expressions, table_name=table_name)
+    if view_sql is None:
+        return None
+    view_name = table_name + handbase_format.calculated_view_suffix
+    db_driver = db_driver or con2driver(connection_string)
+    con = db_driver.connect(connection_string)
+    try:
+        cur = con.cursor()
+        cur.execute('DROP VIEW IF EXISTS "%s"' % view_name)
+        cur.execute(view_sql)
+        cur.close()
+        con.commit()
+    finally:
+        con.close()
+    return view_name
+
+
+def load_streams(connection_string, sources, num_workers=4, batch_size=500, max_pending_batches=64, db_driver=None, param_marker='?'):
+    """Load many CSV streams into one database, one table per stream.
+    Existing tables with the same name are replaced.
+
+    Each stream is loaded into a staging table (STAGING_TABLE_PREFIX + table_name),
+    once complete the old table is dropped and the staging table renamed in
+    one transaction (SQLite3 triggers on the table are recreated and its
+    full text index, TABLE_fts, rebuilt). If a stream fails only the staging
+    table is dropped, the existing table is left as it was.
+
+    sources - list of tuples (table_name, callable). The callable takes no
+        arguments and returns a tuple of (ddl_sql, metadata, rows) where rows
+        is an iterator of CSV rows, header first (e.g. from handbase_format.csv_reader()).
+        ddl_sql and metadata may be None, in which case all columns are STRING.
+        ddl_sql must start with CREATE TABLE "table_name".
+
+    Callables are called, and their rows read and converted, in worker
+    threads so downloading/parsing overlaps with inserting. All SQL is
+    issued from the calling thread on a single connection.
+
+    Returns dictionary of table_name -> row count, or the exception instance
+    if that table failed to load.
+    """
+    db_driver = db_driver or con2driver(connection_string)
+    source_queue = queue.Queue()
+    for source in sources:
+        source_queue.put(source)
+    num_workers = max(1, min(num_workers, len(sources)))
+    for dummy in range(num_workers):
+        source_queue.put(None)
+    out_queue = queue.Queue(maxsize=max_pending_batches)  # back pressure, bounds memory
+
+    def worker():
+        while True:
+            source = source_queue.get()
+            if source is None:
+                break
+            table_name, get_source = source
+            try:
+                ddl_sql, metadata, rows = get_source()
+                try:
+                    header = next(rows)
+                except StopIteration:
+                    raise ValueError('empty CSV, no header for %r' % table_name)
+                if metadata and len(metadata['columns']) != len(header):
+                    # PDB schema does not line up with CSV, fall back to strings
+                    ddl_sql = metadata = None
+                staging_table_name = STAGING_TABLE_PREFIX + table_name
+                if ddl_sql is not None:
+                    ddl_sql = staging_ddl(ddl_sql, table_name, staging_table_name)
+                ddl_sql, dml_sql = header_to_sql(header, staging_table_name, param_marker=param_marker, ddl_sql=ddl_sql)
+                out_queue.put((LOAD_TABLE, table_name, (ddl_sql, dml_sql)))
+                convert_row = handbase_format.build_row_converter(metadata, sql=True)
+                batch = []
+                for row in rows:
+                    batch.append(tuple(convert_row(row)))
+                    if len(batch) >= batch_size:
+                        out_queue.put((LOAD_ROWS, table_name, batch))
+                        batch = []
+                if batch:
+                    out_queue.put((LOAD_ROWS, table_name, batch))
+                out_queue.put((LOAD_DONE, table_name, None))
+            except Exception as info:
+                out_queue.put((LOAD_ERROR, table_name, info))
+        out_queue.put((LOAD_WORKER_EXIT, None, None))
+
+    for dummy in range(num_workers):
+        t = threading.Thread(target=worker)
+        t.daemon = True
+        t.start()
+
+    results = {}
+    dml_statements = {}
+    con = db_driver.connect(connection_string)
+    try:
+        cur = con.cursor()
+        if db_driver == sqlite3:
+            # RENAME must not check views (e.g. TABLE_calc) on the table being replaced
+            cur.execute('PRAGMA legacy_alter_table = ON')
+        running_workers = num_workers
+        while running_workers:
+            message_type, table_name, payload = out_queue.get()
+            if message_type == LOAD_WORKER_EXIT:
+                running_workers -= 1
+                continue
+            if isinstance(results.get(table_name), Exception):
+                continue  # already failed, drain remaining messages
+            try:
+                if message_type == LOAD_TABLE:
+                    ddl_sql, dml_statements[table_name] = payload
+                    cur.execute('DROP TABLE IF EXISTS "%s"' % (STAGING_TABLE_PREFIX + table_name))  # left over from an interrupted load
+                    cur.execute(ddl_sql)
+                    results[table_name] = 0
+                elif message_type == LOAD_ROWS:
+                    cur.executemany(dml_statements[table_name], payload)
+                    results[table_name] += len(payload)
+                elif message_type == LOAD_DONE:
+                    # other tables' rows so far only touch their staging tables
+                    con.commit()
+                    try:
+                        triggers_sql = []
+                        fts_name = None
+                        if db_driver == sqlite3:
+                            cur.execute('BEGIN')  # otherwise DDL runs in autocommit
+                            # triggers go with the dropped table, e.g. those keeping TABLE_fts in sync
+                            cur.execute("SELECT sql FROM sqlite_master WHERE type = 'trigger' AND tbl_name = ?", (table_name,))
+                            triggers_sql = [row[0] for row in cur.fetchall()]
+                            cur.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = ?", (table_name + handbase_format.fts_table_suffix,))
+                            row = cur.fetchone()
+                            if row:
+                                fts_name = row[0]
+                        cur.execute('DROP TABLE IF EXISTS "%s"' % table_name)
+                        cur.execute('ALTER TABLE "%s" RENAME TO "%s"' % (STAGING_TABLE_PREFIX + table_name, table_name))
+                        for trigger_sql in triggers_sql:
+                            cur.execute(trigger_sql)
+                        if fts_name:
+                            # external content index still has the old rows (and rowids)
+                            cur.execute('INSERT INTO "%s" ("%s") VALUES (\'rebuild\')' % (fts_name, fts_name))
+                        con.commit()
+                    except:
+                        con.rollback()
+                        raise
+                elif message_type == LOAD_ERROR:
+                    raise payload
+            except Exception as info:
+                results[table_name] = info
+                if table_name in dml_statements:
+                    # existing table is untouched, only the partial load goes
+                    cur.execute('DROP TABLE IF EXISTS "%s"' % (STAGING_TABLE_PREFIX + table_name))
+                con.commit()
+        cur.close()
+        con.commit()
+    finally:
+        con.close()
+    return results
 
 
 def main(argv=None):
@@ -142,6 +335,9 @@ Examples:
     parser.add_option("--pdb", help="Optional HanDBase filename, used to generate DDL (data ignored, data comes from CSV)")
     parser.add_option("-t", "--table", help="Table name, if not set defaults based on filename")
     parser.add_option("-e", "--encoding", help="Character encoding. WARNING HanDBase (v4) ONLY supports cp1252, NOT utf-8, only set if you know what you are doing", default='cp1252')
+    parser.add_option("--fts", help="Create SQLite3 full text (FTS5) index over Text and Note columns, requires --pdb", action="store_true")
+    parser.add_option("--formulas", help="JSON file of Calculated/Conditional column name to SQL expression, creates view TABLE%s, requires --pdb" % handbase_format.calculated_view_suffix)
+    parser.add_option("--ndjson", help="Write newline delimited JSON to this file (- for stdout) instead of loading into a database, typed if --pdb is set")
     parser.add_option("-v", "--verbose", help='Verbose', action="store_true")
 
     (options, args) = parser.parse_args(argv[1:])
@@ -150,6 +346,19 @@ Examples:
         parser.print_help()
         print('\n MISSING CSV filename')  # stderr?
         return 1
+    if options.fts and not options.pdb:
+        parser.print_help()
+        print('\n --fts requires --pdb')  # stderr?
+        return 1
+    if options.formulas and not options.pdb:
+        parser.print_help()
+        print('\n --formulas requires --pdb')  # stderr?
+        return 1
+
+    ndjson_file = None
+    if options.ndjson == '-':
+        ndjson_file = sys.stdout
+        sys.stdout = sys.stderr  # keep progress messages out of the records
 
     verbose = options.verbose
     if verbose:
@@ -175,20 +384,40 @@ Examples:
             table_name_override = table_name
         else:
             table_name_override = None
-        f = open(options.pdb, 'rb')
-        data = f.read()
-        f.close()
-        metadata = handbase_format.extract_metadata(data, include_unused=False, include_heading=True)  # they show up in CSV!?
+        metadata = handbase_format.read_metadata(options.pdb)
         ddl_sql = handbase_format.meta2sql_ddl(metadata, table_name=table_name_override)
         if table_name is None:
             table_name = metadata['table_name']
     else:
         ddl_sql = None
+        metadata = None
+
+    if options.ndjson:
+        if ndjson_file is None:
+            ndjson_file = open(options.ndjson, 'w')
+        try:
+            row_count = csv_to_ndjson(csv_filename, ndjson_file, metadata=metadata, encoding=options.encoding)
+        finally:
+            if options.ndjson == '-':
+                sys.stdout = ndjson_file
+            else:
+                ndjson_file.close()
+        sys.stderr.write('%d rows written to %s\n' % (row_count, options.ndjson))
+        return 0
 
     if not table_name:
         table_name = 'default_table'  # FIXME, use databasename?
 
     dump_csv_to_db(csv_filename, connection_string, table_name, ddl_sql=ddl_sql, encoding=options.encoding, metadata=metadata)
+    if options.fts:
+        fts_name = create_fts_index(connection_string, table_name, metadata)
+        print('full text index: %r' % fts_name)
+    if options.formulas:
+        f = open(options.formulas, 'r')
+        expressions = json.load(f)
+        f.close()
+        view_name = create_calculated_view(connection_string, table_name, metadata, expressions=expressions)
+        print('calculated view: %r' % view_name)
 
     return 0
 
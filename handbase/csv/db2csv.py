@@ -5,12 +5,23 @@
 """sqlite3 or ODBC to CSV that's suitable for Handbase (for Android).
 
 Currently assumes stdout which has implications for locale... This is temporary for debugging purposes!
+
+Use --all or --tables to export many tables, in parallel, to cp1252 files
+(one per table) ready for import into HanDBase.
+
+With the PDB of the target database (--pdb, --pdb-dir) values are written
+the way HanDBase writes them; "No Date"/"No Time"/"No Value" for NULL,
+MM/DD/YYYY dates, "HH:MM pm" times and 0/1 Check-Boxes. Float decimal
+places are not in the (decoded) PDB, --decimal-places sets them.
 """
 
 import csv
+import io
+import multiprocessing
 import os
 import sqlite3
 import sys
+import time
 
 try:
     #raise ImportError  # DEBUG force pypyodbc usage
@@ -22,6 +33,18 @@ except ImportError:
     except ImportError:
         pyodbc = None
 
+from cli import MyOptionParser
+import handbase_format
+
+is_py3 = sys.version_info >= (3,)
+
+
+__version__ = '0.0.0'
+
+HANDBASE_ENCODING = 'cp1252'
+fetch_size = 1000
+
+
 def con2driver(connection_string):
     if connection_string == ':memory:':
         return sqlite3
@@ -38,7 +61,10 @@ def con2driver(connection_string):
         return pyodbc
     return sqlite3
 
-def dump_db_to_csv(connection_string, table_name, output_file=sys.stdout, sql=None, db_driver=None):
+def dump_db_to_csv(connection_string, table_name, output_file=sys.stdout, sql=None, db_driver=None, metadata=None):
+    """metadata - optional schema of target database (handbase_format.extract_metadata()),
+    if set values are formatted for HanDBase, see handbase_format.build_row_formatter()
+    """
     db_driver = db_driver or con2driver(connection_string)
 
     # Assume SQLite3 syntax; db_driver == sqlite3
@@ -49,12 +75,17 @@ def dump_db_to_csv(connection_string, table_name, output_file=sys.stdout, sql=No
     cur = con.cursor()
     cur.execute(sql)
     column_names = list(x[0] for x in cur.description)
-    out_csv.writerow(column_names) 
-    row = cur.fetchone()
-    while row:
-        #print(row)
-        out_csv.writerow(row)
-        row = cur.fetchone()
+    out_csv.writerow(column_names)
+    format_row = None
+    if metadata:
+        format_row = handbase_format.build_row_formatter(metadata, column_names)
+    rows = cur.fetchmany(fetch_size)
+    while rows:
+        #print(rows)
+        if format_row:
+            rows = [format_row(row) for row in rows]
+        out_csv.writerows(rows)
+        rows = cur.fetchmany(fetch_size)
     # caller responsible for closing out file...
 
     cur.close()
@@ -62,15 +93,215 @@ def dump_db_to_csv(connection_string, table_name, output_file=sys.stdout, sql=No
     con.close()
 
 
+def list_tables(connection_string, db_driver=None):
+    """Returns list of user table names.
+    Skips SQLite internal tables, full text indexes (and their shadow tables) and
+    tables internal to these tools, see handbase_format.user_table_names().
+    """
+    db_driver = db_driver or con2driver(connection_string)
+    con = db_driver.connect(connection_string)
+    try:
+        cur = con.cursor()
+        if db_driver == sqlite3:
+            cur.execute("SELECT name, sql FROM sqlite_master WHERE type = 'table' ORDER BY name")
+            result = handbase_format.user_table_names(cur.fetchall())
+        else:
+            result = [row[2] for row in cur.tables(tableType='TABLE')]  # table_name
+        cur.close()
+    finally:
+        con.close()
+    return result
+
+
+def parse_decimal_places(text):
+    """'2' (every Float column) or 'Price=2,Ratio=4' -> dictionary for
+    metadata['decimal_places'], see handbase_format.build_row_formatter()
+    """
+    result = {}
+    for item in text.split(','):
+        if '=' in item:
+            column_name, places = item.rsplit('=', 1)
+            result[column_name.strip()] = int(places)
+        elif item.strip():
+            result[None] = int(item)
+    return result
+
+
+def find_pdb(directory, table_name):
+    """Returns filename of TABLE.PDB (case insensitive) in directory, or None"""
+    wanted = (table_name + '.pdb').lower()
+    for filename in os.listdir(directory):
+        if filename.lower() == wanted:
+            return os.path.join(directory, filename)
+    return None
+
+
+def export_table(connection_string, table_name, filename, encoding=HANDBASE_ENCODING, db_driver=None, metadata=None):
+    """Export table to CSV file filename, in encoding.
+    Values are formatted for HanDBase (per column formatters built once, applied
+    a batch at a time), using metadata (schema of the target database) if set,
+    see handbase_format.build_row_formatter().
+    Characters not in the encoding are transliterated or replaced, see transcode.py.
+    Uses its own connection, so can run at the same time as other exports.
+    Returns dictionary with table_name, filename, rows, bytes, seconds and replaced (number of characters).
+    """
+    import transcode  # only needed for file exports
+
+    start_time = time.time()
+    db_driver = db_driver or con2driver(connection_string)
+    con = db_driver.connect(connection_string)
+    out_file = open(filename, 'wb')
+    row_count = 0
+    replaced = 0
+    try:
+        if is_py3:
+            out_text = io.TextIOWrapper(out_file, encoding=encoding, newline='')
+            out_csv = csv.writer(out_text)
+        else:
+            out_csv = csv.writer(out_file)
+
+        def write_rows(rows):
+            rows, problems = transcode.transcode_rows(rows)
+            if not is_py3:
+                rows = [[x.encode(encoding) for x in row] for row in rows]
+            out_csv.writerows(rows)
+            return len(problems)
+
+        cur = con.cursor()
+        cur.execute('select * from "%s"' % table_name)
+        column_names = [x[0] for x in cur.description]
+        format_row = handbase_format.build_row_formatter(metadata, column_names)
+        replaced += write_rows([column_names])
+        rows = cur.fetchmany(fetch_size)
+        while rows:
+            replaced += write_rows([format_row(row) for row in rows])
+            row_count += len(rows)
+            rows = cur.fetchmany(fetch_size)
+        cur.close()
+        if is_py3:
+            out_text.flush()
+            out_text.detach()
+    finally:
+        out_file.close()
+        con.close()
+    return {
+        'table_name': table_name,
+        'filename': filename,
+        'rows': row_count,
+        'bytes': os.path.getsize(filename),
+        'seconds': time.time() - start_time,
+        'replaced': replaced,
+    }
+
+
+def export_table_worker(args):
+    """multiprocessing.Pool worker, errors are returned (in 'error') rather than raised"""
+    connection_string, table_name, filename, pdb_filename, decimal_places = args
+    try:
+        metadata = None
+        if pdb_filename:
+            metadata = handbase_format.read_metadata(pdb_filename)
+            metadata['decimal_places'] = decimal_places
+        return export_table(connection_string, table_name, filename, metadata=metadata)
+    except Exception as info:
+        return {'table_name': table_name, 'filename': filename, 'error': repr(info)}
+
+
+def export_tables(connection_string, table_names, output_directory='.', num_workers=None, pdb_directory=None, decimal_places=None):
+    """Export each table to output_directory/TABLE.csv, in parallel (one process and read connection per table).
+    num_workers - number of processes, defaults to number of CPUs
+    pdb_directory - optional directory with TABLE.PDB files, schema used for formatting values
+    decimal_places - optional Float decimal places for tables with a PDB, see parse_decimal_places()
+    Returns list of export_table() results, in table_names order.
+    Failed tables have an 'error' entry instead of counts.
+    """
+    work = []
+    for table_name in table_names:
+        pdb_filename = None
+        if pdb_directory:
+            pdb_filename = find_pdb(pdb_directory, table_name)
+        work.append((connection_string, table_name, os.path.join(output_directory, table_name + '.csv'), pdb_filename, decimal_places))
+    if not work:
+        return []
+    pool = multiprocessing.Pool(min(num_workers or multiprocessing.cpu_count(), len(work)))
+    try:
+        results = pool.map(export_table_worker, work, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    return results
+
 
 def main(argv=None):
     if argv is None:
         argv = sys.argv
 
-    connection_string = argv[1]
-    table_name = argv[2]
-    dump_db_to_csv(connection_string, table_name)
+    usage = "usage: %prog [options] connection_string [table_name]"
+    description = '''SQLite3/ODBC tables to CSV suitable for HanDBase'''
+    example_usage = '''
+Examples:
+
+    %prog somedb.sqlite3 quotes  # one table to stdout
+    %prog somedb.sqlite3 --all -o out_dir  # every table to out_dir/TABLE.csv
+    %prog somedb.sqlite3 --tables quotes,prices -o out_dir -j 2
+    %prog somedb.sqlite3 quotes --pdb quotes.PDB  # format values for HanDBase
+    %prog somedb.sqlite3 --all -o out_dir --pdb-dir backup_dir  # uses backup_dir/TABLE.PDB where present
+    %prog somedb.sqlite3 quotes --pdb quotes.PDB --decimal-places Price=2,Ratio=4
+'''
+    parser = MyOptionParser(usage=usage, version="%%prog %s" % __version__, description=description, epilog=example_usage)
+    parser.add_option("--all", help="Export all tables, one file per table", action="store_true")
+    parser.add_option("--tables", help="Export comma separated list of tables, one file per table")
+    parser.add_option("-o", "--output-dir", help="Directory for exported files, default %default", default='.')
+    parser.add_option("--pdb", help="HanDBase PDB of the target database (single table), values are formatted to match its field types")
+    parser.add_option("--pdb-dir", help="Directory of TABLE.PDB files, for --all/--tables")
+    parser.add_option("--decimal-places", help="Float decimal places (0-4) as set in HanDBase, not read from the PDB (yet); N for every Float column or COLUMN=N,... Without this floats are written in full")
+    parser.add_option("-j", "--jobs", help="Number of tables to export at once, defaults to number of CPUs", type="int")
+
+    (options, args) = parser.parse_args(argv[1:])
+    if not args or not (options.all or options.tables or len(args) > 1):
+        parser.print_help()
+        print('\n MISSING connection string and/or table name')  # stderr?
+        return 1
+    connection_string = args[0]
+    decimal_places = None
+    if options.decimal_places:
+        decimal_places = parse_decimal_places(options.decimal_places)
+
+    if not (options.all or options.tables):
+        table_name = args[1]
+        metadata = None
+        if options.pdb:
+            metadata = handbase_format.read_metadata(options.pdb)
+            metadata['decimal_places'] = decimal_places
+        dump_db_to_csv(connection_string, table_name, metadata=metadata)
+        return 0
+
+    if options.all:
+        table_names = list_tables(connection_string)
+    else:
+        table_names = [x.strip() for x in options.tables.split(',') if x.strip()]
+    if not os.path.isdir(options.output_dir):
+        os.makedirs(options.output_dir)
+
+    start_time = time.time()
+    results = export_tables(connection_string, table_names, output_directory=options.output_dir, num_workers=options.jobs, pdb_directory=options.pdb_dir, decimal_places=decimal_places)
+    failures = 0
+    total_rows = total_bytes = 0
+    for result in results:
+        if 'error' in result:
+            failures += 1
+            print('%30s FAILED %s' % (result['table_name'], result['error']))
+            continue
+        total_rows += result['rows']
+        total_bytes += result['bytes']
+        replaced = ''
+        if result['replaced']:
+            replaced = ' (%d characters replaced)' % result['replaced']
+        print('%30s %8d rows %10d bytes%s' % (result['table_name'], result['rows'], result['bytes'], replaced))
+    print('%d tables, %d rows, %d bytes in %.2f seconds' % (len(results), total_rows, total_bytes, time.time() - start_time))
 
+    if failures:
+        return 1
     return 0
 
 
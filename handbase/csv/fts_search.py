@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: us-ascii -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+#
+"""Full text search of SQLite3 tables indexed by csv2db.py --fts
+
+Example:
+
+    csv2db.py notes.csv --pdb notes.PDB -d notes.sqlite3 --fts
+    fts_search.py -d notes.sqlite3 "invoice AND overdue"
+    fts_search.py -d notes.sqlite3 -t notes "pump*"
+
+Query syntax is SQLite FTS5, see https://www.sqlite.org/fts5.html#full_text_query_syntax
+"""
+
+import sqlite3
+import sys
+
+from cli import MyOptionParser
+import handbase_format
+
+
+__version__ = '0.0.0'
+
+
+def fts_tables(con):
+    """Returns list of (table_name, fts_table_name) full text indexed tables
+    """
+    cur = con.cursor()
+    cur.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND sql LIKE 'CREATE VIRTUAL TABLE%USING fts5%' ORDER BY name")
+    suffix = handbase_format.fts_table_suffix
+    result = [(name[:-len(suffix)], name) for (name,) in cur.fetchall() if name.endswith(suffix)]
+    cur.close()
+    return result
+
+
+def search(connection_string, query, table_name=None, limit=20):
+    """Generator, returns (table_name, rowid, snippet) best matches first (per table)
+    """
+    con = sqlite3.connect(connection_string)
+    try:
+        tables = fts_tables(con)
+        if table_name:
+            tables = [x for x in tables if x[0] == table_name]
+            if not tables:
+                raise KeyError('no full text index for table %r' % table_name)
+        cur = con.cursor()
+        for content_table_name, fts_name in tables:
+            cur.execute('''SELECT rowid, snippet("%s", -1, '[', ']', '...', 12)
+                FROM "%s" WHERE "%s" MATCH ?
+                ORDER BY rank LIMIT ?''' % (fts_name, fts_name, fts_name), (query, limit))
+            for rowid, snippet in cur.fetchall():
+                yield content_table_name, rowid, snippet
+        cur.close()
+    finally:
+        con.close()
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+
+    usage = "usage: %prog [options] query"
+    description = '''Full text search of Text and Note columns'''
+    example_usage = '''
+Examples:
+
+    %prog -d notes.sqlite3 "invoice AND overdue"
+    %prog -d notes.sqlite3 -t notes "pump*"
+'''
+    parser = MyOptionParser(usage=usage, version="%%prog %s" % __version__, description=description, epilog=example_usage)
+    parser.add_option("-d", "--dbname", help="SQL (SQLite3) Database name")
+    parser.add_option("-t", "--table", help="Table name, if not set searches all indexed tables")
+    parser.add_option("-n", "--limit", help="Maximum number of results per table, default %default", type="int", default=20)
+
+    (options, args) = parser.parse_args(argv[1:])
+    if not options.dbname or not args:
+        parser.print_help()
+        print('\n MISSING database name and/or query')  # stderr?
+        return 1
+
+    query = ' '.join(args)
+    for table_name, rowid, snippet in search(options.dbname, query, table_name=options.table, limit=options.limit):
+        print('%s\t%d\t%s' % (table_name, rowid, snippet.replace('\n', ' ')))
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+# -*- coding: us-ascii -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+#
+"""Generate synthetic HanDBase CSV exports (and matching PDB column metadata) for scale testing.
+
+Covers every type in handbase_format.datatypes and respects the limits
+in the README; 100 fields, 254 byte Text, 2000 byte Note, 1904-2031
+dates, "No Date"/"No Time"/"No Value" NULLs, embedded newlines and
+non-ASCII cp1252 characters. Rows are streamed to disk, so millions of
+rows only need memory for one row.
+
+Example:
+
+    generate.py -o big.csv --pdb big.PDB -r 1000000 -c 40
+    csv2db.py big.csv --pdb big.PDB -d big.sqlite3
+"""
+
+import csv
+import datetime
+import io
+import random
+import sys
+
+from cli import MyOptionParser
+import handbase_format
+
+is_py3 = sys.version_info >= (3,)
+
+
+__version__ = '0.0.0'
+
+# Types that can be generated, in the order columns are assigned
+column_datatypes = sorted(x for x in handbase_format.datatypes if handbase_format.datatypes[x] != handbase_format.HANDBASE_TYPE_UNUSED)
+
+# cp1252 text, including characters outside latin1 (Euro, curly quotes) and CSV specials
+text_alphabet = (
+    u'abcdefghijklmnopqrstuvwxyz' * 4 +
+    u'ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789' +
+    u'      ' * 4 +
+    u',."\'-' +
+    u'\xe9\xe8\xe0\xfc\xf1\xe7\xc9\xd6\xdf\u20ac\u201c\u201d\u2018\u2019\u2013\u2014\u2026'
+)
+popup_values = [u'Red', u'Green', u'Blue', u'Caf\xe9', u'Other']
+
+
+def make_metadata(column_count=len(column_datatypes), table_name='generated', text_length=handbase_format.MAX_TEXT_LENGTH, seed=None):
+    """Returns metadata (see handbase_format.extract_metadata()) with column_count columns,
+    cycling through every datatype.
+    """
+    if column_count > handbase_format.MAX_FIELDS:
+        raise ValueError('too many columns %d, max %d' % (column_count, handbase_format.MAX_FIELDS))
+    rng = random.Random(seed)
+    metadata = {'table_name': table_name, 'columns': [], 'links': [], 'formulas': []}
+    for column_number in range(column_count):
+        column_datatype = column_datatypes[column_number % len(column_datatypes)]
+        column_datatype_text = handbase_format.datatypes[column_datatype]
+        column_name = '%s %d' % (column_datatype_text.split()[-1], column_number + 1)  # 'Signature or Sketch' is too long for a field name
+        column_length = 0
+        if column_datatype_text == handbase_format.HANDBASE_TYPE_TEXT:
+            column_length = rng.randint(1, text_length)
+        elif column_datatype_text in (handbase_format.HANDBASE_TYPE_LINKED, handbase_format.HANDBASE_TYPE_DBPOPUP):
+            metadata['links'].append({
+                'column_name': column_name,
+                'datatype_text': column_datatype_text,
+                'linked_table_name': table_name + '_parent',
+                'linked_column_name': None,
+            })
+        metadata['columns'].append((column_name, column_datatype, column_datatype_text, column_length))
+    return metadata
+
+
+class ValueGenerator(object):
+    """Makes CSV (string) values, as exported by HanDBase, for each datatype.
+    Text comes from slices of a random buffer generated once, rather than
+    character by character, so generation is not the bottleneck.
+    """
+
+    def __init__(self, seed=None, null_rate=0.1, newline_rate=0.05):
+        self.rng = random.Random(seed)
+        self.null_rate = null_rate
+        buffer_length = 64 * 1024
+        text = [self.rng.choice(text_alphabet) for dummy in range(buffer_length)]
+        for dummy in range(int(buffer_length * newline_rate / 50)):
+            text[self.rng.randrange(buffer_length)] = u'\n'
+        self.text_buffer = u''.join(text)
+        self.date_min = handbase_format.DATE_MIN.toordinal()
+        self.date_max = handbase_format.DATE_MAX.toordinal()
+        self.generators = {
+            handbase_format.HANDBASE_TYPE_TEXT: self.text,
+            handbase_format.HANDBASE_TYPE_NOTE: self.note,
+            handbase_format.HANDBASE_TYPE_INTEGER: self.integer,
+            handbase_format.HANDBASE_TYPE_FLOAT: self.float,
+            handbase_format.HANDBASE_TYPE_POPUP: self.popup,
+            handbase_format.HANDBASE_TYPE_DBPOPUP: self.popup,
+            handbase_format.HANDBASE_TYPE_CHECKBOX: self.checkbox,
+            handbase_format.HANDBASE_TYPE_UNIQUELEGACY: self.unique,
+            handbase_format.HANDBASE_TYPE_DATE: self.date,
+            handbase_format.HANDBASE_TYPE_TIME: self.time,
+            handbase_format.HANDBASE_TYPE_LINKED: self.linked,
+            handbase_format.HANDBASE_TYPE_CALCULATED: self.float,
+            handbase_format.HANDBASE_TYPE_CONDITIONAL: self.float,
+            # always empty in CSV
+            handbase_format.HANDBASE_TYPE_SKETCH: self.empty,
+            handbase_format.HANDBASE_TYPE_HEADING: self.empty,
+            handbase_format.HANDBASE_TYPE_EXTERNAL: self.empty,
+        }
+
+    def text_of_length(self, max_length):
+        length = self.rng.randint(0, max_length)
+        start = self.rng.randrange(len(self.text_buffer) - length)
+        return self.text_buffer[start:start + length]
+
+    def text(self, row_number, column_length):
+        return self.text_of_length(column_length or handbase_format.MAX_TEXT_LENGTH)
+
+    def note(self, row_number, column_length):
+        return self.text_of_length(handbase_format.MAX_NOTE_LENGTH)
+
+    def integer(self, row_number, column_length):
+        return '%d' % self.rng.randint(handbase_format.INTEGER_MIN, handbase_format.INTEGER_MAX)
+
+    def float(self, row_number, column_length):
+        return '%.*f' % (self.rng.randint(0, 4), self.rng.uniform(-999999999, 999999999))
+
+    def popup(self, row_number, column_length):
+        if self.rng.random() < self.null_rate:
+            return handbase_format.NO_VALUE
+        return self.rng.choice(popup_values)
+
+    def checkbox(self, row_number, column_length):
+        return self.rng.choice(('0', '1'))
+
+    def unique(self, row_number, column_length):
+        return '%d' % (row_number + 1)
+
+    def date(self, row_number, column_length):
+        if self.rng.random() < self.null_rate:
+            return handbase_format.NO_DATE
+        value = datetime.date.fromordinal(self.rng.randint(self.date_min, self.date_max))
+        return '%02d/%02d/%04d' % (value.month, value.day, value.year)
+
+    def time(self, row_number, column_length):
+        if self.rng.random() < self.null_rate:
+            return handbase_format.NO_TIME
+        hour = self.rng.randint(1, 12)
+        return '%02d:%02d %s' % (hour, self.rng.randint(0, 59), self.rng.choice(('am', 'pm')))
+
+    def linked(self, row_number, column_length):
+        return '%d' % self.rng.randint(1, 1000)
+
+    def empty(self, row_number, column_length):
+        return ''
+
+
+def generate_rows(metadata, row_count, seed=None, null_rate=0.1):
+    """Generator, returns header then row_count rows (lists of unicode strings) in HanDBase CSV export format
+    """
+    values = ValueGenerator(seed=seed, null_rate=null_rate)
+    column_generators = [(values.generators[column[2]], column[3]) for column in metadata['columns']]
+    yield [column[0] for column in metadata['columns']]
+    for row_number in range(row_count):
+        yield [generator(row_number, column_length) for generator, column_length in column_generators]
+
+
+def write_csv(out_file, rows, encoding='cp1252', batch_size=1000):
+    """Stream rows to binary file-like object out_file, returns number of rows written (including header)
+    """
+    if is_py3:
+        out_text = io.TextIOWrapper(out_file, encoding=encoding, newline='')
+        out_csv = csv.writer(out_text)
+    else:
+        out_csv = csv.writer(out_file)
+    row_count = 0
+    batch = []
+    for row in rows:
+        if not is_py3:
+            row = [x.encode(encoding) for x in row]
+        batch.append(row)
+        if len(batch) >= batch_size:
+            out_csv.writerows(batch)
+            row_count += len(batch)
+            batch = []
+    out_csv.writerows(batch)
+    row_count += len(batch)
+    if is_py3:
+        out_text.flush()
+        out_text.detach()  # caller owns out_file
+    return row_count
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+
+    usage = "usage: %prog [options]"
+    description = '''Generate synthetic HanDBase CSV export and PDB column metadata'''
+    example_usage = '''
+Examples:
+
+    %prog -o test.csv --pdb test.PDB -r 1000
+    %prog -o big.csv -r 1000000 -c 100 --seed 42
+'''
+    parser = MyOptionParser(usage=usage, version="%%prog %s" % __version__, description=description, epilog=example_usage)
+    parser.add_option("-o", "--output", help="CSV filename to write")
+    parser.add_option("--pdb", help="Optional PDB filename to write, column metadata only (no records)")
+    parser.add_option("-t", "--table", help="Table name, default %default", default='generated')
+    parser.add_option("-r", "--rows", help="Number of rows, default %default", type="int", default=1000)
+    parser.add_option("-c", "--columns", help="Number of columns (max %d), default one per datatype (%%default)" % handbase_format.MAX_FIELDS, type="int", default=len(column_datatypes))
+    parser.add_option("--null-rate", help="Fraction of No Date/No Time/No Value, default %default", type="float", default=0.1)
+    parser.add_option("--seed", help="Random seed, for repeatable data", type="int")
+
+    (options, args) = parser.parse_args(argv[1:])
+    if not options.output:
+        parser.print_help()
+        print('\n MISSING output filename')  # stderr?
+        return 1
+
+    metadata = make_metadata(column_count=options.columns, table_name=options.table, seed=options.seed)
+    if options.pdb:
+        f = open(options.pdb, 'wb')
+        f.write(handbase_format.metadata2pdb(metadata))
+        f.close()
+
+    f = open(options.output, 'wb')
+    try:
+        row_count = write_csv(f, generate_rows(metadata, options.rows, seed=options.seed, null_rate=options.null_rate))
+    finally:
+        f.close()
+    print('%d rows, %d columns written to %s' % (row_count - 1, len(metadata['columns']), options.output))
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -23,8 +23,16 @@ Example:
 
 """
 
+import binascii
+import collections
+import csv
+import datetime
+import decimal
+import functools
+import io
 import json
 import os
+import re
 import struct
 import sys
 
@@ -32,6 +40,20 @@ is_py3 = sys.version_info >= (3,)
 
 max_field_length = len('Field 1 mmmmmmmmmmm')  # table/database and field/column
 
+# Limits, see README
+MAX_FIELDS = 100  # version 4.x
+MAX_TEXT_LENGTH = 254  # bytes
+MAX_NOTE_LENGTH = 2000  # bytes
+INTEGER_MIN = -1410065407
+INTEGER_MAX = 1215752191
+DATE_MIN = datetime.date(1904, 1, 2)
+DATE_MAX = datetime.date(2031, 12, 31)
+
+# CSV NULL/missing values
+NO_DATE = 'No Date'
+NO_TIME = 'No Time'
+NO_VALUE = 'No Value'
+
 HANDBASE_TYPE_UNUSED = 'UNUSED'
 HANDBASE_TYPE_TEXT = 'Text'
 HANDBASE_TYPE_INTEGER = 'Integer'
@@ -92,8 +114,9 @@ datatypes_to_sql = {
     HANDBASE_TYPE_UNIQUELEGACY: 'integer autoincrementing TODO',
     HANDBASE_TYPE_LINKED: 'unknown_pk_fk',
     HANDBASE_TYPE_SKETCH: 'BLOB not_available_in_csv',
-    HANDBASE_TYPE_CALCULATED: 'math_depends_on_formula_and_src_columns',
-    HANDBASE_TYPE_CONDITIONAL: 'math_depends_on_formula_and_src_columns_use_trigger_view',
+    # value as exported, formula is not decoded; see meta2sql_view() for computing them in SQL
+    HANDBASE_TYPE_CALCULATED: 'float',
+    HANDBASE_TYPE_CONDITIONAL: 'varchar',
 }
 
 def nul_terminated_bytes_to_string(in_bytes):
@@ -116,6 +139,42 @@ def single_byte_to_int(in_byte):
         return ord(in_byte)
 
 
+# Palm OS database (PDB) header, all big-endian
+pdb_header_format = '>32sHHIIIIII4s4sIIH'
+pdb_header_length = struct.calcsize(pdb_header_format)  # 78
+palm_epoch = datetime.datetime(1904, 1, 1)
+
+def palm_seconds_to_datetime(seconds):
+    if not seconds:
+        return None
+    return palm_epoch + datetime.timedelta(seconds=seconds)
+
+def extract_pdb_header(data):
+    """Decode Palm OS PDB header, only needs the first 78 bytes of data.
+    returns dictionary:
+        {
+            "name": "Database name",
+            "type": "HanD",
+            "creator": "HanD",
+            "record_count": int,  # number of PDB records, NOT necessarily the number of rows
+            "created": datetime or None,
+            "modified": datetime or None,
+            "backup": datetime or None,
+        }
+    """
+    (name, attributes, version, created, modified, backup, modification_number,
+        appinfo_offset, sortinfo_offset, db_type, db_creator, unique_id_seed,
+        next_record_list, record_count) = struct.unpack(pdb_header_format, data[:pdb_header_length])
+    return {
+        'name': nul_terminated_bytes_to_string(name),
+        'type': db_type.decode('cp1252'),
+        'creator': db_creator.decode('cp1252'),
+        'record_count': record_count,
+        'created': palm_seconds_to_datetime(created),
+        'modified': palm_seconds_to_datetime(modified),
+        'backup': palm_seconds_to_datetime(backup),
+    }
+
 def extract_metadata(data, number_of_columns=100, include_unused=True, include_heading=True, offset=None):
     """Has no idea about field/column order and instead relies on physical column order
     TODO include_unused and include_heading would likely need to include column number in result set
@@ -132,6 +191,23 @@ def extract_metadata(data, number_of_columns=100, include_unused=True, include_h
                 [
                     "Second Field/Column Table Name, max 19 bytes",
                 ...
+            ],
+            "links": [  # Linked and DB-Pop-Up columns
+                {
+                    "column_name": "Field/Column name",
+                    "datatype_text": "Linked",
+                    "linked_table_name": "Table Name, max 19 bytes",
+                    "linked_column_name": None  # TODO not yet decoded
+                },
+                ...
+            ],
+            "formulas": [  # Calculated and Conditional columns
+                {
+                    "column_name": "Field/Column name",
+                    "datatype_text": "Calculated",
+                    "segment": "hex of raw field/column definition"  # formula not yet decoded
+                },
+                ...
             ]
         }
     """
@@ -140,13 +216,13 @@ def extract_metadata(data, number_of_columns=100, include_unused=True, include_h
     meta_data_marker_start_pos = data.find(b'HanDB')
 
     #offset = offset or 1599
-    offset = offset or (meta_data_marker_start_pos + 609)
-    result = {'columns': []}
+    offset = offset or (meta_data_marker_start_pos + metadata_segment_offset)
+    result = {'columns': [], 'links': [], 'formulas': []}
     table_name = nul_terminated_bytes_to_string(data[0:max_field_length])
     result['table_name'] = table_name
     #print('DEBUG table_name: %r' % (table_name, ))
       # FIXME this offset only seems to work for the reverse enginneered database I created from Android
-    segment_length = 116  # 97 + max_field_length
+    segment_length = metadata_segment_length  # 97 + max_field_length
     #print('DEBUG offset: %r' % (offset, ))
     for column_number in range(1, number_of_columns+1):
         record_data = data[offset:offset+segment_length]
@@ -163,41 +239,471 @@ def extract_metadata(data, number_of_columns=100, include_unused=True, include_h
             continue
         elif datatypes[column_datatype] == HANDBASE_TYPE_HEADING and not include_heading:
             continue
-        elif datatypes[column_datatype] == HANDBASE_TYPE_CALCULATED:
-            # TODO conditional logic?
-            pass
-        elif datatypes[column_datatype] == HANDBASE_TYPE_CONDITIONAL:
-            # TODO conditional logic?
-            pass
-        elif datatypes[column_datatype] == HANDBASE_TYPE_LINKED:
-            linked_table_name = record_data[23:23+max_field_length]  # FIXME do something with this
-            # TODO linked_column_name
-        elif datatypes[column_datatype] == HANDBASE_TYPE_DBPOPUP:
-            linked_table_name = record_data[23:23+max_field_length]  # FIXME do something with this
+        elif datatypes[column_datatype] in (HANDBASE_TYPE_CALCULATED, HANDBASE_TYPE_CONDITIONAL):
+            # TODO decode formula/conditional logic (source columns, operators) into an SQL expression
+            result['formulas'].append({
+                'column_name': column_name,
+                'datatype_text': datatypes[column_datatype],
+                'segment': binascii.hexlify(record_data).decode('ascii'),
+            })
+        elif datatypes[column_datatype] in (HANDBASE_TYPE_LINKED, HANDBASE_TYPE_DBPOPUP):
+            linked_table_name = nul_terminated_bytes_to_string(record_data[23:23+max_field_length])
             # TODO linked_column_name
-            # TODO group number?
+            # TODO DB-Pop-Up group number?
+            if linked_table_name:
+                result['links'].append({
+                    'column_name': column_name,
+                    'datatype_text': datatypes[column_datatype],
+                    'linked_table_name': linked_table_name,
+                    'linked_column_name': None,
+                })
         result['columns'].append((column_name, column_datatype, datatypes[column_datatype], column_length))
     return result
 
-def meta2sql_ddl(metadata, table_name=None):
+def read_metadata(pdb_filename):
+    """Returns extract_metadata() for PDB file pdb_filename, columns as they appear in its CSV export"""
+    f = open(pdb_filename, 'rb')
+    data = f.read()
+    f.close()
+    return extract_metadata(data, include_unused=False, include_heading=True)  # they show up in CSV
+
+def meta2sql_ddl(metadata, table_name=None, foreign_keys=False):
+    """foreign_keys - if True, Linked and DB-Pop-Up columns reference the linked table
+    (REFERENCES when the linked column is known, otherwise an SQL comment), see meta2sql_indexes()
+    """
     table_name = table_name or metadata['table_name']
     result = ['CREATE TABLE "%s" (' % table_name]
     sql_types = []
+    links = {}
+    if foreign_keys:
+        links = dict((link['column_name'], link) for link in metadata.get('links', []))
     for column in metadata['columns']:
         column_name, column_datatype, column_datatype_text, column_length = column
         if column_datatype_text == HANDBASE_TYPE_NOTE:
-            column_length = 2000
+            column_length = MAX_NOTE_LENGTH
         elif column_datatype_text != HANDBASE_TYPE_TEXT:
             column_length = None
         sql_type = datatypes_to_sql[column_datatype_text]
         if column_length:
             sql_type = sql_type + '(%d)' % column_length
+        link = links.get(column_name)
+        if link:
+            if link['linked_column_name']:
+                sql_type = 'string REFERENCES "%s" ("%s")' % (link['linked_table_name'], link['linked_column_name'])
+            else:
+                sql_type = 'string /* links to "%s" */' % link['linked_table_name']
         sql_types.append('    "%s" %s' % (column_name, sql_type))  # TODO NOT NULL/nullable, default value....
     result.append(',\n'.join(sql_types))
     result.append(');')
     # Guess PK? indexes...
     return '\n'.join(result)
 
+def meta2sql_indexes(metadata, table_name=None):
+    """Returns list of CREATE INDEX statements for Linked and DB-Pop-Up (join) columns
+    """
+    table_name = table_name or metadata['table_name']
+    result = []
+    for link in metadata.get('links', []):
+        result.append('CREATE INDEX IF NOT EXISTS "%s_%s_idx" ON "%s" ("%s");' % (table_name, link['column_name'], table_name, link['column_name']))
+    return result
+
+fts_datatypes = (HANDBASE_TYPE_TEXT, HANDBASE_TYPE_NOTE)  # columns worth full text indexing
+fts_table_suffix = '_fts'
+
+def meta2sql_fts_ddl(metadata, table_name=None):
+    """Returns SQLite3 FTS5 DDL (script, multiple statements) for the
+    Text and Note columns in metadata, or None if there are no such columns.
+    Creates an external content FTS5 table, TABLENAME_fts, over TABLENAME
+    plus triggers to keep it in sync with inserts, updates and deletes.
+    Rows already in TABLENAME need a one off:
+        INSERT INTO "TABLENAME_fts" ("TABLENAME_fts") VALUES ('rebuild');
+    """
+    table_name = table_name or metadata['table_name']
+    column_names = [column[0] for column in metadata['columns'] if column[2] in fts_datatypes]
+    if not column_names:
+        return None
+    fts_name = table_name + fts_table_suffix
+    columns = ', '.join(['"%s"' % column_name for column_name in column_names])
+    new_values = ', '.join(['new."%s"' % column_name for column_name in column_names])
+    old_values = ', '.join(['old."%s"' % column_name for column_name in column_names])
+    substitutions = {
+        'table_name': table_name,
+        'fts_name': fts_name,
+        'columns': columns,
+        'new_values': new_values,
+        'old_values': old_values,
+    }
+    return '''CREATE VIRTUAL TABLE IF NOT EXISTS "%(fts_name)s" USING fts5(%(columns)s, content='%(table_name)s', content_rowid='rowid');
+CREATE TRIGGER IF NOT EXISTS "%(fts_name)s_ai" AFTER INSERT ON "%(table_name)s" BEGIN
+    INSERT INTO "%(fts_name)s" (rowid, %(columns)s) VALUES (new.rowid, %(new_values)s);
+END;
+CREATE TRIGGER IF NOT EXISTS "%(fts_name)s_ad" AFTER DELETE ON "%(table_name)s" BEGIN
+    INSERT INTO "%(fts_name)s" ("%(fts_name)s", rowid, %(columns)s) VALUES ('delete', old.rowid, %(old_values)s);
+END;
+CREATE TRIGGER IF NOT EXISTS "%(fts_name)s_au" AFTER UPDATE ON "%(table_name)s" BEGIN
+    INSERT INTO "%(fts_name)s" ("%(fts_name)s", rowid, %(columns)s) VALUES ('delete', old.rowid, %(old_values)s);
+    INSERT INTO "%(fts_name)s" (rowid, %(columns)s) VALUES (new.rowid, %(new_values)s);
+END;
+''' % substitutions
+
+calculated_view_suffix = '_calc'
+
+def meta2sql_view(metadata, expressions=None, table_name=None):
+    """Returns CREATE VIEW statement for TABLENAME_calc; every column of TABLENAME
+    with Calculated and Conditional columns computed by SQL from their source
+    columns, instead of the values frozen at CSV export time.
+    Returns None if there is nothing to compute.
+    expressions - dictionary of column name -> SQL expression over the other columns, e.g.
+        {"Total": '"Price" * "Qty"', "Status": 'CASE WHEN "Done" THEN \'Closed\' ELSE \'Open\' END'}
+        Hand written, the formulas in the PDB are not decoded (metadata['formulas']
+        only has the raw field definitions).
+    Columns without an expression keep the stored value.
+    """
+    table_name = table_name or metadata['table_name']
+    all_expressions = dict(expressions or {})
+    column_names = [column[0] for column in metadata['columns']]
+    unknown_columns = [column_name for column_name in all_expressions if column_name not in column_names]
+    if unknown_columns:
+        raise ValueError('unknown column(s) %r in %r' % (unknown_columns, table_name))
+    if not all_expressions:
+        return None
+    select_columns = []
+    for column_name in column_names:
+        if column_name in all_expressions:
+            select_columns.append('    (%s) AS "%s"' % (all_expressions[column_name], column_name))
+        else:
+            select_columns.append('    "%s"' % column_name)
+    return 'CREATE VIEW "%s" AS SELECT\n%s\nFROM "%s";' % (table_name + calculated_view_suffix, ',\n'.join(select_columns), table_name)
+
+INTERNAL_TABLE_PREFIX = 'handbase_'  # tables these tools create for themselves, e.g. mirror state, staging
+
+def user_table_names(schema_rows):
+    """Returns names of user tables (and views) from SQLite3 schema rows, tuples of (name, sql)
+    e.g. from SELECT name, sql FROM sqlite_master.
+    Skips SQLite internal tables, INTERNAL_TABLE_PREFIX tables, full text indexes
+    (virtual tables) and their shadow tables.
+    """
+    virtual_tables = [name for name, sql in schema_rows if (sql or '').upper().startswith('CREATE VIRTUAL TABLE')]
+    result = []
+    for name, sql in schema_rows:
+        if name.startswith('sqlite_') or name.startswith(INTERNAL_TABLE_PREFIX) or name in virtual_tables:
+            continue
+        if [x for x in virtual_tables if name.startswith(x + '_')]:
+            continue  # e.g. FTS5 NAME_data, NAME_idx
+        result.append(name)
+    return result
+
+def csv_reader(fh, encoding='cp1252', errors='strict'):
+    """Generator, returns rows (list of unicode strings) from CSV in a binary file-like object.
+    fh can be a file on disk or a (streaming) HTTP response, decoding is
+    incremental so only the current row is held in memory.
+    errors is the codec error handler, e.g. 'replace' to get U+FFFD for undecodable bytes.
+    Caller is responsible for closing fh.
+    """
+    if is_py3:
+        text = io.TextIOWrapper(fh, encoding=encoding, errors=errors, newline='')
+        try:
+            for row in csv.reader(text):
+                yield row
+        finally:
+            try:
+                text.detach()  # otherwise garbage collecting the wrapper closes fh
+            except ValueError:
+                pass  # fh already closed
+    else:
+        for row in csv.reader(fh):
+            yield [x.decode(encoding, errors) for x in row]
+
+csv_time_re = re.compile(r'^\d{1,2}:\d{2} [ap]m$', re.IGNORECASE)  # CSV export format, no seconds
+sql_time_re = re.compile(r'^\d{1,2}:\d{2}(:\d{2}(\.\d+)?)?$')  # 24 hour, e.g. SQLite time()
+
+null_sentinels = {
+    HANDBASE_TYPE_DATE: NO_DATE,
+    HANDBASE_TYPE_TIME: NO_TIME,
+}
+
+def csv_date_to_date(value):
+    """'MM/DD/YYYY' -> datetime.date"""
+    date_month, date_day, date_year = value.split('/')
+    return datetime.date(int(date_year), int(date_month), int(date_day))
+
+def csv_time_to_time(value):
+    """'HH:MM pm' -> datetime.time (CSV export does not include seconds)"""
+    hour, rest = value.split(':', 1)
+    minute, am_pm = rest.split()
+    hour = int(hour) % 12
+    if am_pm.lower() == 'pm':
+        hour += 12
+    return datetime.time(hour, int(minute))
+
+def csv_date_to_sql(value):
+    """'MM/DD/YYYY' -> 'YYYY-MM-DD' (string, for SQL)"""
+    return csv_date_to_date(value).isoformat()
+
+def csv_checkbox_to_bool(value):
+    return value == '1'
+
+def csv_float(value):
+    """Float, or for Calculated fields that produce dates/times leave as string"""
+    try:
+        return float(value)
+    except ValueError:
+        return value
+
+def csv_text(value):
+    return value
+
+csv_converters = {
+    HANDBASE_TYPE_TEXT: csv_text,
+    HANDBASE_TYPE_NOTE: csv_text,
+    HANDBASE_TYPE_POPUP: csv_text,
+    HANDBASE_TYPE_DBPOPUP: csv_text,
+    HANDBASE_TYPE_LINKED: csv_text,
+    HANDBASE_TYPE_CONDITIONAL: csv_text,
+    HANDBASE_TYPE_INTEGER: int,
+    HANDBASE_TYPE_UNIQUELEGACY: int,
+    HANDBASE_TYPE_FLOAT: float,
+    HANDBASE_TYPE_CALCULATED: csv_float,
+    HANDBASE_TYPE_CHECKBOX: csv_checkbox_to_bool,
+    HANDBASE_TYPE_DATE: csv_date_to_date,
+    HANDBASE_TYPE_TIME: csv_time_to_time,
+}
+
+# for SQL binding values stay strings (the column type does the rest), except dates
+sql_converters = dict((datatype_text, csv_text) for datatype_text in csv_converters)
+sql_converters[HANDBASE_TYPE_DATE] = csv_date_to_sql
+
+def build_row_converter(metadata=None, sql=False):
+    """Returns function that converts a row (list of strings) from a HanDBase CSV export
+    into a list of Python values; int, float, bool, datetime.date, datetime.time, unicode or None.
+    Converters are looked up once per column, not per value.
+    Values that do not convert (e.g. bad data) are left as strings.
+    Without metadata only the NULL values ("No Date", "No Time", "No Value") are converted (to None).
+
+    sql - values for SQL binding (e.g. csv2db); strings, with dates as
+        'YYYY-MM-DD' and NULLs as None. Empty strings are left as is.
+    """
+    if not metadata:
+        def convert_row(row):
+            return [None if value in (NO_DATE, NO_TIME, NO_VALUE) else value for value in row]
+        return convert_row
+
+    converters = csv_converters
+    if sql:
+        converters = sql_converters
+    column_converters = []
+    for column in metadata['columns']:
+        column_datatype_text = column[2]
+        column_converters.append((converters.get(column_datatype_text), null_sentinels.get(column_datatype_text, NO_VALUE)))
+
+    def convert_row(row):
+        result = []
+        for (converter, null_value), value in zip(column_converters, row):
+            if value == null_value:
+                value = None
+            elif not value:
+                if not sql and converter is not csv_text:
+                    value = None  # includes Heading, Sketch, External; always empty
+            elif converter is not None:
+                try:
+                    value = converter(value)
+                except ValueError:
+                    pass
+            result.append(value)
+        return result
+    return convert_row
+
+csv_null_values = {
+    HANDBASE_TYPE_DATE: NO_DATE,
+    HANDBASE_TYPE_TIME: NO_TIME,
+    HANDBASE_TYPE_POPUP: NO_VALUE,
+    HANDBASE_TYPE_DBPOPUP: NO_VALUE,
+}
+
+def date_to_csv(value):
+    """datetime.date (or ISO 'YYYY-MM-DD...' string, e.g. from SQLite) -> 'MM/DD/YYYY'"""
+    if not isinstance(value, datetime.date):
+        value = datetime.date(int(value[0:4]), int(value[5:7]), int(value[8:10]))
+    return u'%02d/%02d/%04d' % (value.month, value.day, value.year)
+
+def time_to_csv(value):
+    """datetime.time, 24 hour 'HH:MM[:SS]' string (e.g. SQLite time()) or 'HH:MM pm' string
+    (as csv2db stores them) -> 'HH:MM pm', seconds are dropped like the CSV export
+    """
+    if isinstance(value, datetime.datetime):
+        value = value.time()
+    elif not isinstance(value, datetime.time):
+        if csv_time_re.match(value):
+            value = csv_time_to_time(value)
+        elif sql_time_re.match(value):
+            hour, minute = value.split(':')[:2]
+            value = datetime.time(int(hour), int(minute))
+        else:
+            raise ValueError('not a time %r' % (value, ))
+    am_pm = u'am'
+    if value.hour >= 12:
+        am_pm = u'pm'
+    return u'%02d:%02d %s' % (value.hour % 12 or 12, value.minute, am_pm)
+
+def bool_to_csv(value):
+    if isinstance(value, (type(u''), type(''))):
+        value = value.strip().lower() not in ('', '0', 'false', 'f', 'no', 'n')
+    return value and u'1' or u'0'
+
+def integer_to_csv(value):
+    if isinstance(value, float) and value == int(value):
+        value = int(value)
+    return u'%s' % (value, )
+
+def float_to_csv(value, decimal_places=None):
+    """decimal_places - the field's setting (0-4), HanDBase writes exactly that many digits.
+    If not known floats are written in full, shortest form that reads back the same.
+    """
+    if decimal_places is not None and isinstance(value, number_types):
+        return u'%s' % format(value, '.%df' % decimal_places)
+    if isinstance(value, float):
+        return u'%r' % (value, )  # shortest round trip, str() loses digits under Py2
+    return u'%s' % (value, )
+
+def value_to_csv(value):
+    """Format by Python type, for columns with no schema"""
+    if isinstance(value, bool):
+        return bool_to_csv(value)
+    elif isinstance(value, datetime.datetime):
+        return date_to_csv(value) + u' ' + time_to_csv(value)
+    elif isinstance(value, datetime.date):
+        return date_to_csv(value)
+    elif isinstance(value, datetime.time):
+        return time_to_csv(value)
+    elif isinstance(value, float):
+        return float_to_csv(value)
+    elif isinstance(value, type(u'')):
+        return value
+    elif isinstance(value, bytes) and not is_py3:
+        return value.decode('cp1252')  # Py2 str
+    return u'%s' % (value, )
+
+try:
+    number_types = (int, long, float, decimal.Decimal)  # Py2
+except NameError:
+    number_types = (int, float, decimal.Decimal)
+
+csv_formatters = {
+    HANDBASE_TYPE_DATE: date_to_csv,
+    HANDBASE_TYPE_TIME: time_to_csv,
+    HANDBASE_TYPE_CHECKBOX: bool_to_csv,
+    HANDBASE_TYPE_INTEGER: integer_to_csv,
+    HANDBASE_TYPE_UNIQUELEGACY: integer_to_csv,
+    HANDBASE_TYPE_FLOAT: float_to_csv,
+}
+
+def build_row_formatter(metadata=None, header=None):
+    """Returns function that formats a row of SQL values (e.g. from fetchmany())
+    into a list of unicode strings the way HanDBase writes (and reads) CSV;
+    NULL -> "No Date"/"No Time"/"No Value" (empty for other types),
+    dates -> 'MM/DD/YYYY', times -> 'HH:MM pm', booleans -> 0/1.
+    The reverse of build_row_converter().
+    Formatters are looked up once per column, not per value.
+    header - column names of the rows, matched to metadata by name. If not set metadata column order is assumed.
+    Columns not in metadata (or no metadata) are formatted by Python type.
+    Float columns use metadata['decimal_places'] if present, dictionary of column
+    name -> digits after the decimal point (None key for any other Float column),
+    see float_to_csv(). extract_metadata() does not (yet) decode this from the PDB.
+    Values that do not format (e.g. bad data) are passed through as text.
+    """
+    column_types = {}
+    decimal_places = {}
+    if metadata:
+        column_types = dict((column[0], column[2]) for column in metadata['columns'])
+        decimal_places = metadata.get('decimal_places') or {}
+        if header is None:
+            header = [column[0] for column in metadata['columns']]
+    column_formatters = []
+    for column_name in header or []:
+        column_datatype_text = column_types.get(column_name)
+        formatter = csv_formatters.get(column_datatype_text, value_to_csv)
+        if formatter is float_to_csv:
+            places = decimal_places.get(column_name, decimal_places.get(None))
+            if places is not None:
+                formatter = functools.partial(float_to_csv, decimal_places=places)
+        column_formatters.append((formatter, csv_null_values.get(column_datatype_text, u'')))
+
+    if not column_formatters:
+        def format_row(row):
+            return [u'' if value is None else value_to_csv(value) for value in row]
+        return format_row
+
+    def format_row(row):
+        result = []
+        for (formatter, null_value), value in zip(column_formatters, row):
+            if value is None:
+                value = null_value
+            else:
+                try:
+                    value = formatter(value)
+                except (ValueError, TypeError, IndexError):
+                    value = value_to_csv(value)
+            result.append(value)
+        return result
+    return format_row
+
+def json_default(value):
+    """json.dumps() default for build_row_converter() values; dates and times as ISO 8601"""
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    raise TypeError('%r is not JSON serializable' % (value, ))
+
+def write_ndjson(out_file, header, rows, batch_size=1000):
+    """Write rows (lists of values, see build_row_converter()) to text file-like object out_file
+    as newline delimited JSON, one object per row keyed on header.
+    Written (and flushed) a batch at a time, memory use does not depend on number of rows.
+    Returns number of rows written.
+    """
+    row_count = 0
+    batch = []
+    for row in rows:
+        batch.append(json.dumps(collections.OrderedDict(zip(header, row)), default=json_default))  # keep column order
+        if len(batch) >= batch_size:
+            out_file.write('\n'.join(batch) + '\n')
+            out_file.flush()
+            row_count += len(batch)
+            batch = []
+    if batch:
+        out_file.write('\n'.join(batch) + '\n')
+        out_file.flush()
+        row_count += len(batch)
+    return row_count
+
+metadata_segment_offset = 609  # from HanDB marker to first field/column segment
+metadata_segment_length = 116
+
+def metadata2pdb(metadata, marker_offset=0x3c0):
+    """Returns bytes of a minimal PDB (header and field/column definitions, no records)
+    that extract_metadata() can read back. For test data generation, NOT suitable for
+    loading onto a device.
+    """
+    if len(metadata['columns']) > MAX_FIELDS:
+        raise ValueError('too many columns %d, max %d' % (len(metadata['columns']), MAX_FIELDS))
+    segments_offset = marker_offset + metadata_segment_offset
+    data = bytearray(segments_offset + metadata_segment_length * MAX_FIELDS)
+    name = metadata['table_name'].encode('cp1252')[:max_field_length]
+    data[0:len(name)] = name
+    data[60:68] = b'HanDHanD'  # type and creator
+    data[marker_offset:marker_offset + 5] = b'HanDB'
+    links = dict((link['column_name'], link) for link in metadata.get('links', []))
+    for column_number, column in enumerate(metadata['columns']):
+        column_name, column_datatype, column_datatype_text, column_length = column
+        offset = segments_offset + column_number * metadata_segment_length
+        data[offset] = column_datatype
+        data[offset + 2] = min(column_length or 0, 255)
+        name = column_name.encode('cp1252')[:max_field_length]
+        data[offset + 0x41:offset + 0x41 + len(name)] = name
+        link = links.get(column_name)
+        if link:
+            name = link['linked_table_name'].encode('cp1252')[:max_field_length]
+            data[offset + 23:offset + 23 + len(name)] = name
+    return bytes(data)
+
 def main(argv=None):
     if argv is None:
         argv = sys.argv
@@ -216,6 +722,8 @@ def main(argv=None):
     metadata = extract_metadata(data, include_unused=False, include_heading=False, offset=offset)
     sql_ddl = meta2sql_ddl(metadata)
     print('%s' % sql_ddl)
+    for formula in metadata['formulas']:
+        print('-- %s "%s" %s' % (formula['datatype_text'], formula['column_name'], formula['segment']))
 
     return 0
 
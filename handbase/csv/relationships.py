@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+# -*- coding: us-ascii -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+#
+"""Linked / DB-Pop-Up relationships across a backup of HanDBase databases.
+
+Builds a graph of which tables link to (depend on) which, from the PDB
+files in a backup directory (e.g. from `remote.py --downloadall all`), and
+loads the CSV files into SQLite3 in parallel with indexes on the link
+columns. The linked column is not decoded yet so there are no REFERENCES
+constraints and load order does not matter; the graph is for --graph.
+
+Example:
+
+    relationships.py --graph backup_dir  # show graph and load order
+    relationships.py -d backup.sqlite3 backup_dir
+"""
+
+import os
+import sys
+
+from cli import MyOptionParser
+import csv2db
+import handbase_format
+
+
+__version__ = '0.0.0'
+
+PDB_EXTENSION = '.PDB'
+CSV_EXTENSION = '.CSV'
+
+
+def find_backup_files(directory):
+    """Returns list of (pdb_filename, csv_filename) pairs in directory,
+    csv_filename is None if there is no CSV for the PDB. Extensions are case insensitive.
+    """
+    filenames = os.listdir(directory)
+    csv_filenames = dict((x[:-len(CSV_EXTENSION)].lower(), x) for x in filenames if x.upper().endswith(CSV_EXTENSION))
+    result = []
+    for filename in sorted(filenames):
+        if filename.upper().endswith(PDB_EXTENSION):
+            csv_filename = csv_filenames.get(filename[:-len(PDB_EXTENSION)].lower())
+            if csv_filename:
+                csv_filename = os.path.join(directory, csv_filename)
+            result.append((os.path.join(directory, filename), csv_filename))
+    return result
+
+
+def build_graph(metadata_list):
+    """Returns dictionary of table_name -> set of table names it links to (parents).
+    Links to tables not in metadata_list are ignored (and reported via missing).
+    Returns tuple (graph, missing) where missing is a set of (table_name, linked_table_name).
+    """
+    table_names = set(metadata['table_name'] for metadata in metadata_list)
+    graph = {}
+    missing = set()
+    for metadata in metadata_list:
+        parents = set()
+        for link in metadata['links']:
+            linked_table_name = link['linked_table_name']
+            if linked_table_name in table_names:
+                if linked_table_name != metadata['table_name']:
+                    parents.add(linked_table_name)
+            else:
+                missing.add((metadata['table_name'], linked_table_name))
+        graph[metadata['table_name']] = parents
+    return graph, missing
+
+
+def load_order(graph):
+    """Returns list of levels (lists of table names), parents before children.
+    Tables in the same level do not depend on each other.
+    Cycles (which HanDBase allows) are broken by putting the remaining tables in one final level.
+    """
+    remaining = dict((table_name, set(parents)) for table_name, parents in graph.items())
+    levels = []
+    while remaining:
+        level = sorted(table_name for table_name, parents in remaining.items() if not parents)
+        if not level:
+            level = sorted(remaining)  # cycle
+        levels.append(level)
+        for table_name in level:
+            del remaining[table_name]
+        for parents in remaining.values():
+            parents.difference_update(level)
+    return levels
+
+
+def file_source(csv_filename, ddl_sql, metadata, encoding='cp1252'):
+    """Returns a csv2db.load_streams() source callable for a CSV file on disk
+    """
+    def get_source():
+        fh = open(csv_filename, 'rb')
+
+        def rows():
+            try:
+                for row in handbase_format.csv_reader(fh, encoding=encoding):
+                    yield row
+            finally:
+                fh.close()
+        return ddl_sql, metadata, rows()
+    return get_source
+
+
+def load_backup(directory, connection_string, num_workers=4):
+    """Load PDB/CSV pairs in directory into connection_string, num_workers at once,
+    with indexes on link columns.
+    Table names come from the PDB (not the filename), links refer to them.
+    Raises ValueError if two PDBs have the same table name, rather than load one over the other.
+    Returns dictionary, see csv2db.load_streams()
+    """
+    tables = {}
+    pdb_filenames = {}
+    for pdb_filename, csv_filename in find_backup_files(directory):
+        if csv_filename is None:
+            continue
+        metadata = handbase_format.read_metadata(pdb_filename)
+        table_name = metadata['table_name']
+        if table_name in tables:
+            raise ValueError('%s and %s are both table %r, remove or rename one (in HanDBase)' % (pdb_filenames[table_name], pdb_filename, table_name))
+        tables[table_name] = (csv_filename, metadata)
+        pdb_filenames[table_name] = pdb_filename
+
+    missing = build_graph([metadata for csv_filename, metadata in tables.values()])[1]
+    for table_name, linked_table_name in sorted(missing):
+        print('%s links to %s which is not in the backup' % (table_name, linked_table_name))
+
+    sources = []
+    for table_name in sorted(tables):
+        csv_filename, metadata = tables[table_name]
+        ddl_sql = handbase_format.meta2sql_ddl(metadata, foreign_keys=True)
+        sources.append((table_name, file_source(csv_filename, ddl_sql, metadata)))
+    results = csv2db.load_streams(connection_string, sources, num_workers=num_workers)
+
+    db_driver = csv2db.con2driver(connection_string)
+    con = db_driver.connect(connection_string)
+    try:
+        cur = con.cursor()
+        for table_name in tables:
+            if isinstance(results.get(table_name), Exception):
+                continue
+            for index_sql in handbase_format.meta2sql_indexes(tables[table_name][1]):
+                cur.execute(index_sql)
+        cur.close()
+        con.commit()
+    finally:
+        con.close()
+    return results
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+
+    usage = "usage: %prog [options] backup_directory"
+    description = '''Load a directory of HanDBase PDB+CSV files into SQLite3 with indexes on Linked/DB-Pop-Up fields'''
+    example_usage = '''
+Examples:
+
+    %prog --graph backup_dir
+    %prog -d backup.sqlite3 backup_dir
+'''
+    parser = MyOptionParser(usage=usage, version="%%prog %s" % __version__, description=description, epilog=example_usage)
+    parser.add_option("-d", "--dbname", help="SQL (SQLite3) Database name to load into")
+    parser.add_option("--graph", help="Show links and load order only", action="store_true")
+    parser.add_option("-j", "--jobs", help="Number of tables to load at once, default %default", type="int", default=4)
+
+    (options, args) = parser.parse_args(argv[1:])
+    if not args or not (options.dbname or options.graph):
+        parser.print_help()
+        print('\n MISSING backup directory and/or database name')  # stderr?
+        return 1
+    directory = args[0]
+
+    if options.graph:
+        metadata_list = [handbase_format.read_metadata(pdb_filename) for pdb_filename, csv_filename in find_backup_files(directory)]
+        for metadata in metadata_list:
+            for link in metadata['links']:
+                print('%s.%s -> %s (%s)' % (metadata['table_name'], link['column_name'], link['linked_table_name'], link['datatype_text']))
+        graph, missing = build_graph(metadata_list)
+        for level_number, level in enumerate(load_order(graph)):
+            print('level %d: %s' % (level_number, ', '.join(level)))
+        return 0
+
+    results = load_backup(directory, options.dbname, num_workers=options.jobs)
+    failures = 0
+    for table_name in sorted(results):
+        row_count = results[table_name]
+        if isinstance(row_count, Exception):
+            failures += 1
+            print('%30s FAILED %r' % (table_name, row_count))
+        else:
+            print('%30s %8d rows' % (table_name, row_count))
+
+    if failures:
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
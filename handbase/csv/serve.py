@@ -0,0 +1,335 @@
+#!/usr/bin/env python
+# -*- coding: us-ascii -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+#
+"""Read-only HTTP query server for SQLite3 databases loaded by csv2db.py / device2db.py
+
+Serves tables as JSON or CSV so dashboards and reports do not have to
+hit the phone. Filtering, projection, ordering and pagination are pushed
+down into SQLite. Read connections are pooled. Responses are cached until
+the database file changes (e.g. a table is reloaded by the mirror daemon).
+
+    GET /                     list of tables (JSON)
+    GET /TABLE.json           rows as JSON
+    GET /TABLE.csv            rows as CSV (utf-8)
+
+Query parameters:
+
+    columns=a,b,c             projection
+    COLUMN=value              filter, equality
+    COLUMN__like=%value%      filter, also __ne, __lt, __le, __gt, __ge
+    order=COLUMN              order by, -COLUMN for descending
+    limit=100&offset=0        pagination, limit defaults to 100 (max 10000)
+
+BLOB values are returned base64 encoded, in both JSON and CSV.
+
+Example:
+
+    serve.py -d mirror.sqlite3 -p 8080
+    curl "http://localhost:8080/jobs.json?columns=job,client&client=acme&limit=10"
+"""
+
+import base64
+import collections
+import csv
+import io
+import json
+import os
+import sqlite3
+import sys
+import threading
+
+try:
+    # Py3
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qsl, unquote, urlparse
+    from urllib.request import pathname2url
+    import queue
+except ImportError:
+    # Py2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qsl, urlparse
+    from urllib import pathname2url, unquote
+    import Queue as queue
+
+from cli import MyOptionParser
+import handbase_format
+
+is_py3 = sys.version_info >= (3,)
+if is_py3:
+    blob_types = (bytes, bytearray, memoryview)
+else:
+    blob_types = (bytearray, buffer)  # sqlite3 returns buffer for BLOB, unicode for TEXT
+
+
+__version__ = '0.0.0'
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 10000
+filter_operators = {
+    '': '=',
+    'ne': '!=',
+    'lt': '<',
+    'le': '<=',
+    'gt': '>',
+    'ge': '>=',
+    'like': 'LIKE',
+}
+
+
+class QueryError(Exception):
+    """Bad request, e.g. unknown table or column"""
+
+
+def encode_row(row):
+    """Returns row with BLOB values base64 encoded, so it can be written as JSON or CSV"""
+    return [base64.b64encode(bytes(value)).decode('ascii') if isinstance(value, blob_types) else value for value in row]
+
+
+class ConnectionPool(object):
+    """Fixed size pool of read-only SQLite3 connections, safe to share between threads"""
+
+    def __init__(self, filename, size=4):
+        self.filename = filename
+        self.connections = queue.Queue()
+        for dummy in range(size):
+            self.connections.put(self.connect())
+
+    def connect(self):
+        if is_py3:
+            uri = 'file:%s?mode=ro' % pathname2url(os.path.abspath(self.filename))
+            return sqlite3.connect(uri, uri=True, check_same_thread=False)
+        return sqlite3.connect(self.filename, check_same_thread=False)
+
+    def execute(self, sql, parameters=()):
+        """Returns tuple of (column_names, rows)"""
+        con = self.connections.get()
+        try:
+            cur = con.cursor()
+            cur.execute(sql, parameters)
+            column_names = [x[0] for x in cur.description or []]
+            rows = cur.fetchall()
+            cur.close()
+        finally:
+            self.connections.put(con)
+        return column_names, rows
+
+
+class ResponseCache(object):
+    """LRU cache of responses, emptied whenever the database file changes"""
+
+    def __init__(self, filename, max_entries=256):
+        self.filename = filename
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.generation = None
+
+    def current_generation(self):
+        result = []
+        for filename in (self.filename, self.filename + '-wal'):  # WAL mode writes do not touch the main file until checkpoint
+            try:
+                stat_info = os.stat(filename)
+                result.append((stat_info.st_mtime, stat_info.st_size))
+            except OSError:
+                result.append(None)
+        return tuple(result)
+
+    def get(self, key):
+        with self.lock:
+            generation = self.current_generation()
+            if generation != self.generation:
+                self.entries.clear()
+                self.generation = generation
+            value = self.entries.pop(key, None)
+            if value is not None:
+                self.entries[key] = value  # most recently used
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+class QueryServer(object):
+    """Builds (and caches) responses for request paths, independent of the HTTP server"""
+
+    def __init__(self, filename, pool_size=4, cache_entries=256):
+        self.pool = ConnectionPool(filename, size=pool_size)
+        self.cache = ResponseCache(filename, max_entries=cache_entries)
+
+    def table_names(self):
+        """Returns user tables and views, see handbase_format.user_table_names()"""
+        column_names, rows = self.pool.execute("SELECT name, sql FROM sqlite_master WHERE type IN ('table', 'view') ORDER BY name")
+        return handbase_format.user_table_names(rows)
+
+    def column_names(self, table_name):
+        column_names, rows = self.pool.execute('PRAGMA table_info("%s")' % table_name.replace('"', '""'))
+        return [row[1] for row in rows]
+
+    def build_sql(self, table_name, parameters):
+        """Returns (sql, bind_parameters, limit, offset) for table_name and query parameters (list of (key, value)).
+        Table and column names are checked against the schema, values are always bound.
+        """
+        if table_name not in self.table_names():
+            raise QueryError('unknown table %r' % table_name)
+        known_columns = self.column_names(table_name)
+
+        def check_column(column_name):
+            if column_name not in known_columns:
+                raise QueryError('unknown column %r' % column_name)
+            return '"%s"' % column_name.replace('"', '""')
+
+        select_columns = '*'
+        where = []
+        bind_parameters = []
+        order_by = ''
+        limit = DEFAULT_LIMIT
+        offset = 0
+        for key, value in parameters:
+            if key == 'columns':
+                select_columns = ', '.join([check_column(x) for x in value.split(',') if x])
+            elif key == 'order':
+                direction = 'ASC'
+                if value.startswith('-'):
+                    direction = 'DESC'
+                    value = value[1:]
+                order_by = ' ORDER BY %s %s' % (check_column(value), direction)
+            elif key in ('limit', 'offset'):
+                try:
+                    number = int(value)
+                except ValueError:
+                    raise QueryError('%s must be an integer' % key)
+                if key == 'limit':
+                    limit = max(0, min(MAX_LIMIT, number))
+                else:
+                    offset = max(0, number)
+            else:
+                column_name, operator = key, ''
+                if '__' in key:
+                    column_name, operator = key.rsplit('__', 1)
+                if operator not in filter_operators:
+                    raise QueryError('unknown filter %r' % operator)
+                where.append('%s %s ?' % (check_column(column_name), filter_operators[operator]))
+                bind_parameters.append(value)
+
+        sql = 'SELECT %s FROM "%s"' % (select_columns or '*', table_name.replace('"', '""'))
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += order_by + ' LIMIT ? OFFSET ?'
+        bind_parameters += [limit, offset]
+        return sql, bind_parameters, limit, offset
+
+    def response(self, path, query_string):
+        """Returns tuple of (content_type, body bytes), raises QueryError for bad requests"""
+        cache_key = (path, query_string)
+        result = self.cache.get(cache_key)
+        if result is not None:
+            return result
+
+        name = unquote(path.lstrip('/'))
+        if not name:
+            result = ('application/json', json.dumps({'tables': self.table_names()}).encode('utf-8'))
+        else:
+            table_name, extension = os.path.splitext(name)
+            if extension not in ('.json', '.csv'):
+                raise QueryError('unknown format %r, use .json or .csv' % extension)
+            sql, bind_parameters, limit, offset = self.build_sql(table_name, parse_qsl(query_string, keep_blank_values=True))
+            column_names, rows = self.pool.execute(sql, bind_parameters)
+            rows = [encode_row(row) for row in rows]
+            if extension == '.json':
+                body = {
+                    'table': table_name,
+                    'columns': column_names,
+                    'offset': offset,
+                    'limit': limit,
+                    'rows': [dict(zip(column_names, row)) for row in rows],
+                }
+                result = ('application/json', json.dumps(body).encode('utf-8'))
+            else:
+                if is_py3:
+                    out = io.StringIO()
+                else:
+                    out = io.BytesIO()
+                out_csv = csv.writer(out)
+                out_csv.writerow(column_names)
+                out_csv.writerows(rows)
+                body = out.getvalue()
+                if is_py3:
+                    body = body.encode('utf-8')
+                result = ('text/csv; charset=utf-8', body)
+        self.cache.put(cache_key, result)
+        return result
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def make_handler(query_server):
+    class QueryHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlparse(self.path)
+            try:
+                content_type, body = query_server.response(url.path, url.query)
+                code = 200
+            except QueryError as info:
+                content_type, body = 'application/json', json.dumps({'error': str(info)}).encode('utf-8')
+                code = 400
+            except Exception as info:
+                # e.g. sqlite3 errors, always answer rather than drop the connection
+                self.log_error('%s failed %r', self.path, info)
+                self.send_error(500, repr(info))
+                return
+            self.send_response(code)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+    return QueryHandler
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+
+    usage = "usage: %prog [options]"
+    description = '''Read-only JSON/CSV query server over a SQLite3 database'''
+    example_usage = '''
+Examples:
+
+    %prog -d mirror.sqlite3
+    %prog -d mirror.sqlite3 --host 0.0.0.0 -p 8080
+
+    curl "http://localhost:8080/"
+    curl "http://localhost:8080/jobs.json?columns=job,client&client=acme&order=-job&limit=10"
+'''
+    parser = MyOptionParser(usage=usage, version="%%prog %s" % __version__, description=description, epilog=example_usage)
+    parser.add_option("-d", "--dbname", help="SQL (SQLite3) Database name")
+    parser.add_option("--host", help="Address to listen on, default %default", default='127.0.0.1')
+    parser.add_option("-p", "--port", help="Port to listen on, default %default", type="int", default=8080)
+    parser.add_option("--connections", help="Number of pooled read connections, default %default", type="int", default=4)
+    parser.add_option("--cache", help="Number of cached responses, default %default", type="int", default=256)
+
+    (options, args) = parser.parse_args(argv[1:])
+    if not options.dbname:
+        parser.print_help()
+        print('\n MISSING database name')  # stderr?
+        return 1
+
+    query_server = QueryServer(options.dbname, pool_size=options.connections, cache_entries=options.cache)
+    httpd = ThreadingHTTPServer((options.host, options.port), make_handler(query_server))
+    print('Serving %s on http://%s:%d/' % (options.dbname, options.host, options.port))
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
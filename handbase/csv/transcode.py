@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+# -*- coding: us-ascii -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+#
+"""Transcode Unicode text/CSV into cp1252 (Windows-1252), the only encoding HanDBase understands.
+
+Characters that are not in cp1252 are transliterated to look-alikes where
+possible (e.g. U+2011 non-breaking hyphen to "-", U+0142 l with stroke to
+"l", fullwidth letters to ASCII), anything left (emoji, CJK, ...) is
+replaced and reported. Never fails part way through a file, bytes that
+are not valid in the input encoding are reported (and replaced) too.
+
+Work is done per batch of rows (all cells joined into one buffer) using a
+translation table built once at import time, rather than per cell.
+
+Example:
+
+    transcode.py in_utf8.csv upload.csv  # writes cp1252 upload.csv, reports replacements
+    transcode.py --check in_utf8.csv  # report only
+"""
+
+import csv
+import io
+import re
+import sys
+import unicodedata
+
+from cli import MyOptionParser
+
+is_py3 = sys.version_info >= (3,)
+
+try:
+    unichr
+except NameError:
+    # Py3
+    unichr = chr
+
+
+__version__ = '0.0.0'
+
+HANDBASE_ENCODING = 'cp1252'
+DEFAULT_REPLACEMENT = '?'
+CELL_SEPARATOR = u'\x00'
+
+# Look-alikes for characters NOT in cp1252, common in text from word processors, web pages and phones
+lookalikes = {
+    # dashes and hyphens, en/em dash are in cp1252
+    0x2010: u'-', 0x2011: u'-', 0x2012: u'-', 0x2015: u'-', 0x2043: u'-', 0x2212: u'-', 0xfe58: u'-', 0xfe63: u'-',
+    # quotes and primes, curly quotes are in cp1252
+    0x201b: u"'", 0x2032: u"'", 0x2035: u"'", 0x02b9: u"'", 0x02bc: u"'", 0x02c8: u"'",
+    0x201f: u'"', 0x2033: u'"', 0x2036: u'"', 0x02ba: u'"', 0x301d: u'"', 0x301e: u'"',
+    0x2024: u'.', 0x2025: u'..',
+    # spaces
+    0x2000: u' ', 0x2001: u' ', 0x2002: u' ', 0x2003: u' ', 0x2004: u' ', 0x2005: u' ', 0x2006: u' ',
+    0x2007: u' ', 0x2008: u' ', 0x2009: u' ', 0x200a: u' ', 0x202f: u' ', 0x205f: u' ', 0x3000: u' ',
+    # invisible
+    0x200b: u'', 0x200c: u'', 0x200d: u'', 0x2060: u'', 0xfeff: u'', 0xfe0f: u'',
+    # line/paragraph separators
+    0x2028: u'\n', 0x2029: u'\n',
+    # maths and symbols
+    0x2044: u'/', 0x2215: u'/', 0x2216: u'\\', 0x2217: u'*', 0x2219: u'\u2022', 0x22c5: u'\xb7',
+    0x2264: u'<=', 0x2265: u'>=', 0x2260: u'!=', 0x2248: u'~', 0x223c: u'~',
+    0x2190: u'<-', 0x2192: u'->', 0x2194: u'<->', 0x21d2: u'=>',
+    0x2116: u'No', 0x2103: u'\xb0C', 0x2109: u'\xb0F',
+    0x2023: u'\u2022', 0x25cf: u'\u2022', 0x25e6: u'\u2022',
+    0x2713: u'v', 0x2714: u'v', 0x2717: u'x', 0x2718: u'x',
+    # letters without a Unicode decomposition
+    0x0131: u'i', 0x0141: u'L', 0x0142: u'l', 0x0110: u'D', 0x0111: u'd', 0x0126: u'H', 0x0127: u'h',
+    0x0166: u'T', 0x0167: u't', 0x0138: u'q', 0x014a: u'N', 0x014b: u'n', 0x0149: u"'n",
+    0x0132: u'IJ', 0x0133: u'ij', 0x013f: u'L', 0x0140: u'l', 0x0180: u'b', 0x0197: u'I', 0x01b5: u'Z', 0x01b6: u'z',
+    0x0259: u'e', 0x018f: u'E',
+}
+
+# Ranges where NFKD decomposition (minus combining marks) gives a usable look-alike
+decompose_ranges = (
+    (0x0100, 0x024f),  # Latin Extended-A and B
+    (0x0300, 0x036f),  # combining marks (left over after NFC), removed
+    (0x1e00, 0x1eff),  # Latin Extended Additional (Vietnamese, etc.)
+    (0x2070, 0x209f),  # superscripts and subscripts
+    (0x2150, 0x218f),  # number forms, e.g. 1/3
+    (0x2460, 0x24ff),  # enclosed alphanumerics
+    (0xfb00, 0xfb06),  # latin ligatures
+    (0xff01, 0xff5e),  # fullwidth ASCII
+)
+
+
+def is_cp1252(text):
+    try:
+        text.encode(HANDBASE_ENCODING)
+        return True
+    except UnicodeEncodeError:
+        return False
+
+
+def build_translation_table():
+    """Returns dictionary, suitable for unicode.translate(), of code point -> cp1252 look-alike string.
+    Only contains code points that are NOT in cp1252.
+    """
+    table = {}
+    for codepoint, replacement in lookalikes.items():
+        if not is_cp1252(unichr(codepoint)):
+            table[codepoint] = replacement
+    for start, end in decompose_ranges:
+        for codepoint in range(start, end + 1):
+            character = unichr(codepoint)
+            if codepoint in table or is_cp1252(character):
+                continue
+            decomposed = unicodedata.normalize('NFKD', character)
+            decomposed = u''.join([x for x in decomposed if not unicodedata.combining(x)])
+            decomposed = decomposed.translate(table)
+            if is_cp1252(decomposed):
+                table[codepoint] = decomposed
+    return table
+
+
+def build_unencodable_re():
+    """Returns compiled regex that matches any single character NOT in cp1252"""
+    allowed = []
+    for byte_value in range(256):
+        try:
+            allowed.append(bytes(bytearray([byte_value])).decode(HANDBASE_ENCODING))
+        except UnicodeDecodeError:
+            pass  # 0x81, 0x8D, 0x8F, 0x90, 0x9D are undefined
+    return re.compile(u'[^%s]' % u''.join([re.escape(x) for x in allowed]))
+
+
+translation_table = build_translation_table()
+unencodable_re = build_unencodable_re()
+
+
+def transliterate(text):
+    """Returns NFC normalized text with look-alikes substituted, may still contain non-cp1252 characters"""
+    return unicodedata.normalize('NFC', text).translate(translation_table)
+
+
+def transcode_text(text, replacement=DEFAULT_REPLACEMENT):
+    """Returns tuple of (cp1252 safe text, list of (offset, character) that had to be replaced)
+    Offsets are into the transliterate()'d text, before replacement.
+    """
+    if unencodable_re.search(text) is None:
+        return text, []  # already cp1252 (which is NFC), nothing to do
+    text = transliterate(text)
+    problems = [(match.start(), match.group()) for match in unencodable_re.finditer(text)]
+    if problems:
+        text = unencodable_re.sub(replacement, text)
+    return text, problems
+
+
+def transcode_rows(rows, replacement=DEFAULT_REPLACEMENT, first_row_number=0):
+    """Transcode a batch of rows (lists of unicode strings) into cp1252 safe rows.
+    Returns tuple of (new_rows, problems) where problems is a list of
+    (row_number, column_number, character) for characters that were replaced.
+    new_rows is rows itself when it is already cp1252.
+    """
+    cells = [cell for row in rows for cell in row]
+    buffer = CELL_SEPARATOR.join(cells)
+    if buffer.count(CELL_SEPARATOR) != max(0, len(cells) - 1):
+        # separator in the data, cannot split batch back up, do it the slow way
+        new_rows = []
+        problems = []
+        for row_number, row in enumerate(rows, first_row_number):
+            new_row = []
+            for column_number, cell in enumerate(row):
+                new_cell, cell_problems = transcode_text(cell, replacement=replacement)
+                new_row.append(new_cell)
+                problems.extend([(row_number, column_number, character) for offset, character in cell_problems])
+            new_rows.append(new_row)
+        return new_rows, problems
+
+    problems = []
+    if unencodable_re.search(buffer) is None:
+        return rows, problems  # already cp1252 (which is NFC), the common case; skip transliterate()
+    buffer = transliterate(buffer)
+    if unencodable_re.search(buffer):
+        # map buffer offsets back to row/column, only when there are problems
+        cell_ends = []
+        offset = 0
+        for cell in buffer.split(CELL_SEPARATOR):
+            offset += len(cell)
+            cell_ends.append(offset)
+            offset += len(CELL_SEPARATOR)
+        cell_locations = [(row_number, column_number) for row_number, row in enumerate(rows, first_row_number) for column_number in range(len(row))]
+        cell_index = 0
+        for match in unencodable_re.finditer(buffer):
+            while cell_ends[cell_index] <= match.start():
+                cell_index += 1
+            row_number, column_number = cell_locations[cell_index]
+            problems.append((row_number, column_number, match.group()))
+        buffer = unencodable_re.sub(replacement, buffer)
+
+    new_cells = buffer.split(CELL_SEPARATOR)
+    new_rows = []
+    position = 0
+    for row in rows:
+        new_rows.append(new_cells[position:position + len(row)])
+        position += len(row)
+    return new_rows, problems
+
+
+def transcode_csv(in_file, out_file=None, in_encoding='utf-8', replacement=DEFAULT_REPLACEMENT, batch_size=1000):
+    """Read CSV in_file (binary file-like object, in_encoding), write cp1252 CSV to out_file (binary file-like object).
+    If out_file is None, only checks.
+    Returns tuple of (header, row_count, problems) where problems is a
+    list of (row_number, column_number, character), row_number 0 is the header.
+    Bytes not valid in in_encoding are reported as U+FFFD (and replaced).
+    """
+    out_text = None
+    if is_py3:
+        in_csv = csv.reader(io.TextIOWrapper(in_file, encoding=in_encoding, errors='replace', newline=''))
+        if out_file is not None:
+            out_text = io.TextIOWrapper(out_file, encoding=HANDBASE_ENCODING, newline='')
+            out_csv = csv.writer(out_text)
+    else:
+        in_csv = ([x.decode(in_encoding, 'replace') for x in row] for row in csv.reader(in_file))
+        if out_file is not None:
+            out_csv = csv.writer(out_file)
+
+    def write_rows(rows):
+        if out_file is None:
+            return
+        if not is_py3:
+            rows = [[x.encode(HANDBASE_ENCODING) for x in row] for row in rows]
+        out_csv.writerows(rows)
+
+    header = None
+    problems = []
+    batch = []
+    row_number = 0
+    for row in in_csv:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            new_rows, batch_problems = transcode_rows(batch, replacement=replacement, first_row_number=row_number)
+            problems.extend(batch_problems)
+            header = header or new_rows[0]
+            write_rows(new_rows)
+            row_number += len(batch)
+            batch = []
+    if batch:
+        new_rows, batch_problems = transcode_rows(batch, replacement=replacement, first_row_number=row_number)
+        problems.extend(batch_problems)
+        header = header or new_rows[0]
+        write_rows(new_rows)
+        row_number += len(batch)
+    if out_text is not None:
+        out_text.flush()
+        out_text.detach()  # caller owns out_file
+    row_count = max(0, row_number - 1)  # exclude header
+    return header, row_count, problems
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+
+    usage = "usage: %prog [options] in_filename.csv [out_filename.csv]"
+    description = '''Transcode CSV into cp1252 for HanDBase, transliterating where possible'''
+    example_usage = '''
+Examples:
+
+    %prog in_utf8.csv upload.csv
+    %prog -e latin1 in.csv upload.csv
+    %prog --check in_utf8.csv
+'''
+    parser = MyOptionParser(usage=usage, version="%%prog %s" % __version__, description=description, epilog=example_usage)
+    parser.add_option("-e", "--encoding", help="Input character encoding, default %default", default='utf-8')
+    parser.add_option("-r", "--replacement", help="Replacement for characters with no cp1252 look-alike, default %default", default=DEFAULT_REPLACEMENT)
+    parser.add_option("--check", help="Only report, do not write output", action="store_true")
+    parser.add_option("--strict", help="Exit with error if any characters had to be replaced", action="store_true")
+    parser.add_option("--max-report", help="Maximum number of problems to list, default %default", type="int", default=20)
+
+    (options, args) = parser.parse_args(argv[1:])
+    if not args or (len(args) < 2 and not options.check):
+        parser.print_help()
+        print('\n MISSING CSV filename(s)')  # stderr?
+        return 1
+
+    in_file = open(args[0], 'rb')
+    out_file = None
+    if not options.check:
+        out_file = open(args[1], 'wb')
+    try:
+        header, row_count, problems = transcode_csv(in_file, out_file, in_encoding=options.encoding, replacement=options.replacement)
+    finally:
+        in_file.close()
+        if out_file is not None:
+            out_file.close()
+
+    print('rows: %d replaced characters: %d' % (row_count, len(problems)))
+    for row_number, column_number, character in problems[:options.max_report]:
+        column_name = column_number
+        if header and column_number < len(header):
+            column_name = header[column_number]
+        print('row %d column %r: %r U+%04X %s' % (row_number, column_name, character, ord(character), unicodedata.name(character, '?')))
+
+    if problems and options.strict:
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
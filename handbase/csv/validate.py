@@ -0,0 +1,331 @@
+#!/usr/bin/env python
+# -*- coding: us-ascii -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+#
+"""Check a CSV file or SQL table against a HanDBase PDB schema and the HanDBase limits, before uploading.
+
+One streaming pass, so large files only need memory for one batch of rows.
+Checks (see README):
+
+  * number of fields (max 100), header against PDB field names
+  * Text length (field definition, max 254 bytes) and Note length (2000 bytes)
+  * Integer format and range, Float format
+  * Date format (MM/DD/YYYY in CSV) and range 1904-01-02 to 2031-12-31
+  * Time format ("HH:MM pm" in CSV), Check-Box 0/1
+  * every value encodable in cp1252
+
+HanDBase silently truncates or mangles most of these on import.
+Reports violation counts per column and the first offending rows.
+
+Example:
+
+    validate.py --pdb jobs.PDB jobs.csv
+    validate.py --pdb jobs.PDB -d jobs.sqlite3 -t jobs
+"""
+
+import datetime
+import json
+import re
+import sys
+
+from cli import MyOptionParser
+from db2csv import con2driver
+import handbase_format
+import transcode
+
+
+__version__ = '0.0.0'
+
+sql_date_re = re.compile(r'^\d{4}-\d{2}-\d{2}')  # ISO, e.g. SQLite date(), may have a time part
+integer_re = re.compile(r'^-?[0-9]+\Z')  # no spaces, underscores, +, exponents
+float_re = re.compile(r'^-?[0-9]+(\.[0-9]+)?\Z')  # no nan/inf either
+fetch_size = 1000
+text_types = (type(u''), type(''))
+
+
+def is_finite(value):
+    """value is a number from SQL, False for nan/inf"""
+    return not (value != value or value in (float('inf'), float('-inf')))
+
+
+def check_text(value, max_length, sql):
+    if not isinstance(value, text_types):
+        value = u'%s' % (value, )  # SQL number in a Text column
+    if len(value) > max_length:  # cp1252 is one byte per character
+        return 'longer than %d bytes' % max_length
+    return None
+
+def check_integer(value, max_length, sql):
+    if isinstance(value, text_types):
+        if not integer_re.match(value):
+            return 'not an integer'
+        value = int(value)
+    elif not (sql and isinstance(value, handbase_format.number_types) and is_finite(value) and value == int(value)):
+        return 'not an integer'  # e.g. date from SQL
+    if not (handbase_format.INTEGER_MIN <= value <= handbase_format.INTEGER_MAX):
+        return 'integer out of range'
+    return None
+
+def check_float(value, max_length, sql):
+    if isinstance(value, text_types):
+        if not float_re.match(value):
+            return 'not a number'
+    elif not (sql and isinstance(value, handbase_format.number_types) and is_finite(value)):
+        return 'not a number'
+    return None
+
+def check_checkbox(value, max_length, sql):
+    if value in ('0', '1') or (sql and value in (0, 1)):  # True/False compare equal to 1/0
+        return None
+    return 'not 0/1'
+
+def check_date(value, max_length, sql):
+    if sql and isinstance(value, datetime.date):
+        date_value = value
+    elif not isinstance(value, text_types):
+        return 'bad date format'
+    else:
+        try:
+            if sql and sql_date_re.match(value):
+                date_value = datetime.date(int(value[0:4]), int(value[5:7]), int(value[8:10]))
+            else:
+                date_value = handbase_format.csv_date_to_date(value)
+        except ValueError:
+            return 'bad date format'
+    if isinstance(date_value, datetime.datetime):
+        date_value = date_value.date()
+    if not (handbase_format.DATE_MIN <= date_value <= handbase_format.DATE_MAX):
+        return 'date out of range'
+    return None
+
+def check_time(value, max_length, sql):
+    if sql and isinstance(value, datetime.time):
+        return None
+    if not isinstance(value, text_types):
+        return 'bad time format'
+    if handbase_format.csv_time_re.match(value) or (sql and handbase_format.sql_time_re.match(value)):
+        try:
+            if ' ' in value:
+                handbase_format.csv_time_to_time(value)
+                if not 1 <= int(value.split(':', 1)[0]) <= 12:
+                    return 'bad time format'
+            else:
+                datetime.time(*[int(float(x)) for x in value.split(':')])
+            return None
+        except ValueError:
+            pass
+    return 'bad time format'
+
+def check_empty(value, max_length, sql):
+    return None  # Heading, Sketch, External; whatever is sent is ignored
+
+column_checks = {
+    handbase_format.HANDBASE_TYPE_TEXT: check_text,
+    handbase_format.HANDBASE_TYPE_NOTE: check_text,
+    handbase_format.HANDBASE_TYPE_POPUP: check_text,
+    handbase_format.HANDBASE_TYPE_DBPOPUP: check_text,
+    handbase_format.HANDBASE_TYPE_LINKED: check_text,
+    handbase_format.HANDBASE_TYPE_CONDITIONAL: check_text,
+    handbase_format.HANDBASE_TYPE_CALCULATED: check_text,  # number, date or time; computed by HanDBase
+    handbase_format.HANDBASE_TYPE_INTEGER: check_integer,
+    handbase_format.HANDBASE_TYPE_UNIQUELEGACY: check_integer,
+    handbase_format.HANDBASE_TYPE_FLOAT: check_float,
+    handbase_format.HANDBASE_TYPE_CHECKBOX: check_checkbox,
+    handbase_format.HANDBASE_TYPE_DATE: check_date,
+    handbase_format.HANDBASE_TYPE_TIME: check_time,
+    handbase_format.HANDBASE_TYPE_HEADING: check_empty,
+    handbase_format.HANDBASE_TYPE_SKETCH: check_empty,
+    handbase_format.HANDBASE_TYPE_EXTERNAL: check_empty,
+}
+
+
+class Validator(object):
+    """Streaming validation of rows against metadata (handbase_format.extract_metadata())
+    and the HanDBase limits. Call check_header() once then check_rows() for each batch.
+
+    sql - rows come from a database (None for NULL, int, float, date, ISO strings)
+        rather than a CSV file (strings in HanDBase export format)
+
+    Results:
+        problem_counts - dictionary of column name -> dictionary of problem -> count
+        examples - list of (row_number, column_name, value, problem), first max_examples only
+    """
+
+    def __init__(self, metadata=None, sql=False, max_examples=20):
+        self.metadata = metadata
+        self.sql = sql
+        self.max_examples = max_examples
+        self.problem_counts = {}
+        self.examples = []
+        self.row_count = 0
+        self.header = []
+        self.column_checks = []
+
+    def problem(self, row_number, column_name, value, problem):
+        column_counts = self.problem_counts.setdefault(column_name, {})
+        column_counts[problem] = column_counts.get(problem, 0) + 1
+        if len(self.examples) < self.max_examples:
+            self.examples.append((row_number, column_name, value, problem))
+
+    def check_header(self, header):
+        """Checks field names/count, builds the per column checks (once, not per row)"""
+        self.header = list(header)
+        if len(header) > handbase_format.MAX_FIELDS:
+            self.problem(0, '(header)', len(header), 'more than %d fields' % handbase_format.MAX_FIELDS)
+        for column_name in header:
+            if transcode.unencodable_re.search(column_name) is not None:
+                self.problem(0, column_name, column_name, 'field name not cp1252')
+            if len(column_name) > handbase_format.max_field_length:
+                self.problem(0, column_name, column_name, 'field name longer than %d bytes' % handbase_format.max_field_length)
+
+        if not self.metadata:
+            # no schema, only encoding (and generic Note length) checks
+            self.column_checks = [(check_text, handbase_format.MAX_NOTE_LENGTH, handbase_format.NO_VALUE)] * len(header)
+            return
+        columns = self.metadata['columns']
+        if len(columns) != len(header):
+            self.problem(0, '(header)', len(header), 'PDB has %d fields' % len(columns))
+        for column, column_name in zip(columns, header):
+            if column[0] != column_name:
+                self.problem(0, column_name, column_name, 'PDB field is named %r' % column[0])
+        self.column_checks = []
+        for column in columns:
+            column_datatype_text, column_length = column[2], column[3]
+            if column_datatype_text == handbase_format.HANDBASE_TYPE_NOTE:
+                max_length = handbase_format.MAX_NOTE_LENGTH
+            elif column_datatype_text != handbase_format.HANDBASE_TYPE_TEXT:
+                max_length = handbase_format.MAX_TEXT_LENGTH  # byte 2 is only a length for Text fields
+            else:
+                max_length = min(column_length or handbase_format.MAX_TEXT_LENGTH, handbase_format.MAX_TEXT_LENGTH)
+            null_value = handbase_format.null_sentinels.get(column_datatype_text, handbase_format.NO_VALUE)
+            self.column_checks.append((column_checks[column_datatype_text], max_length, null_value))
+
+    def check_rows(self, rows):
+        sql = self.sql
+        unencodable_search = transcode.unencodable_re.search
+        for row in rows:
+            self.row_count += 1
+            row_number = self.row_count
+            if len(row) != len(self.column_checks):
+                self.problem(row_number, '(row)', len(row), 'has %d fields, expected %d' % (len(row), len(self.column_checks)))
+            for (check, max_length, null_value), column_name, value in zip(self.column_checks, self.header, row):
+                if value is None or value == null_value or (value == '' and check is not check_text):
+                    continue  # NULL
+                if isinstance(value, text_types) and unencodable_search(value) is not None:
+                    self.problem(row_number, column_name, value, 'not cp1252')
+                    continue
+                problem = check(value, max_length, sql)
+                if problem:
+                    self.problem(row_number, column_name, value, problem)
+
+    def violation_count(self):
+        return sum(sum(counts.values()) for counts in self.problem_counts.values())
+
+    def report(self):
+        """Returns dictionary suitable for JSON"""
+        return {
+            'rows': self.row_count,
+            'violations': self.violation_count(),
+            'columns': self.problem_counts,
+            'examples': [{'row': row_number, 'column': column_name, 'value': value, 'problem': problem} for row_number, column_name, value, problem in self.examples],
+        }
+
+
+def validate_csv(csv_filename, metadata=None, encoding='cp1252', batch_size=fetch_size, max_examples=20):
+    """Returns Validator with results for CSV file, row numbers exclude the header.
+    Bytes that are not valid in encoding are decoded as U+FFFD and reported as 'not cp1252'.
+    """
+    validator = Validator(metadata, sql=False, max_examples=max_examples)
+    fh = open(csv_filename, 'rb')
+    try:
+        in_csv = handbase_format.csv_reader(fh, encoding=encoding, errors='replace')
+        try:
+            validator.check_header(next(in_csv))
+        except StopIteration:
+            return validator  # empty file
+        batch = []
+        for row in in_csv:
+            batch.append(row)
+            if len(batch) >= batch_size:
+                validator.check_rows(batch)
+                batch = []
+        validator.check_rows(batch)
+    finally:
+        fh.close()
+    return validator
+
+
+def validate_table(connection_string, table_name, metadata=None, db_driver=None, batch_size=fetch_size, max_examples=20):
+    """Returns Validator with results for SQL table, rows are read with fetchmany()"""
+    validator = Validator(metadata, sql=True, max_examples=max_examples)
+    db_driver = db_driver or con2driver(connection_string)
+    con = db_driver.connect(connection_string)
+    try:
+        cur = con.cursor()
+        cur.execute('select * from "%s"' % table_name)
+        validator.check_header([x[0] for x in cur.description])
+        rows = cur.fetchmany(batch_size)
+        while rows:
+            validator.check_rows(rows)
+            rows = cur.fetchmany(batch_size)
+        cur.close()
+    finally:
+        con.close()
+    return validator
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+
+    usage = "usage: %prog [options] [filename.csv]"
+    description = '''Check CSV file or SQL table against HanDBase PDB schema and limits before upload'''
+    example_usage = '''
+Examples:
+
+    %prog --pdb jobs.PDB jobs.csv
+    %prog --pdb jobs.PDB -d jobs.sqlite3 -t jobs
+    %prog -e utf-8 from_elsewhere.csv  # no schema, field count and cp1252 only
+'''
+    parser = MyOptionParser(usage=usage, version="%%prog %s" % __version__, description=description, epilog=example_usage)
+    parser.add_option("--pdb", help="HanDBase PDB filename of the target database, for the schema")
+    parser.add_option("-d", "--dbname", help="SQL (SQLite3) Database name, check table instead of CSV file")
+    parser.add_option("-t", "--table", help="Table name, required with --dbname")
+    parser.add_option("-e", "--encoding", help="CSV character encoding, default %default", default='cp1252')
+    parser.add_option("-n", "--examples", help="Number of offending values to show, default %default", type="int", default=20)
+    parser.add_option("--json", help="Output report as JSON", action="store_true")
+
+    (options, args) = parser.parse_args(argv[1:])
+    if not (args or (options.dbname and options.table)):
+        parser.print_help()
+        print('\n MISSING CSV filename or database and table name')  # stderr?
+        return 1
+
+    metadata = None
+    if options.pdb:
+        metadata = handbase_format.read_metadata(options.pdb)
+
+    if options.dbname:
+        validator = validate_table(options.dbname, options.table, metadata=metadata, max_examples=options.examples)
+    else:
+        validator = validate_csv(args[0], metadata=metadata, encoding=options.encoding, max_examples=options.examples)
+
+    if options.json:
+        print(json.dumps(validator.report(), indent=4, default=handbase_format.json_default))
+    else:
+        for column_name in sorted(validator.problem_counts):
+            for problem, count in sorted(validator.problem_counts[column_name].items()):
+                print('%30s %8d %s' % (column_name, count, problem))
+        if validator.examples:
+            print('')
+            for row_number, column_name, value, problem in validator.examples:
+                print('row %d %s: %s %r' % (row_number, column_name, problem, value))
+        print('%d rows, %d violations' % (validator.row_count, validator.violation_count()))
+
+    if validator.violation_count():
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# -*- coding: us-ascii -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+#
+"""Tests for the PDB catalog, catalog.py
+
+    python -m unittest discover -s handbase/tests
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'csv'))
+import catalog
+import handbase_format
+
+
+class TestScanPdbFile(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.temp_dir, 'jobs.PDB')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def write_pdb(self, data):
+        f = open(self.filename, 'wb')
+        f.write(data)
+        f.close()
+
+    def test_late_marker(self):
+        """field/column segments past read_head_size are read, not truncated"""
+        columns = [('Field %d' % x, 1, handbase_format.HANDBASE_TYPE_TEXT, 40) for x in range(handbase_format.MAX_FIELDS)]
+        marker_offset = catalog.read_head_size - handbase_format.metadata_segment_offset - 10 * handbase_format.metadata_segment_length
+        self.write_pdb(handbase_format.metadata2pdb({'table_name': 'jobs', 'columns': columns}, marker_offset=marker_offset))
+        path, details, scanned_columns = catalog.scan_pdb_file(self.filename)
+        self.assertEqual(details['error'], None)
+        self.assertEqual(details['table_name'], 'jobs')
+        self.assertEqual([column[1] for column in scanned_columns], [column[0] for column in columns])
+
+    def test_not_handbase(self):
+        """other Palm OS databases are errors, not tables with no fields"""
+        data = bytearray(handbase_format.metadata2pdb({'table_name': 'MemoDB', 'columns': []}))
+        data[60:68] = b'DATAmemo'
+        self.write_pdb(bytes(data))
+        path, details, columns = catalog.scan_pdb_file(self.filename)
+        self.assertEqual(columns, [])
+        self.assertTrue('not a HanDBase PDB' in details['error'], details['error'])
+
+
+if __name__ == '__main__':
+    unittest.main()
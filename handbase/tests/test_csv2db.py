@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# -*- coding: us-ascii -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+#
+"""Tests for csv2db.load_streams()
+
+    python -m unittest discover -s handbase/tests
+"""
+
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'csv'))
+import csv2db
+import handbase_format
+
+
+def rows_source(rows, fail_after=None):
+    """Returns load_streams() source callable, raises IOError after fail_after rows (like a dropped download)"""
+    def get_source():
+        def generate_rows():
+            for row_count, row in enumerate(rows):
+                if fail_after is not None and row_count > fail_after:
+                    raise IOError('connection dropped')
+                yield row
+        return None, None, generate_rows()
+    return get_source
+
+
+class TestLoadStreams(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.temp_dir, 'mirror.sqlite3')
+        result = csv2db.load_streams(self.filename, [('jobs', rows_source([['name'], ['old 1'], ['old 2']]))])
+        self.assertEqual(result, {'jobs': 2})
+        con = sqlite3.connect(self.filename)
+        con.execute('CREATE VIEW jobs_calc AS SELECT name, length(name) AS name_length FROM jobs')
+        con.commit()
+        con.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def query(self, sql):
+        con = sqlite3.connect(self.filename)
+        try:
+            return con.execute(sql).fetchall()
+        finally:
+            con.close()
+
+    def test_reload_replaces_table(self):
+        result = csv2db.load_streams(self.filename, [('jobs', rows_source([['name'], ['new 1'], ['new 2'], ['new 3']]))])
+        self.assertEqual(result, {'jobs': 3})
+        self.assertEqual(self.query('SELECT name FROM jobs ORDER BY name'), [('new 1', ), ('new 2', ), ('new 3', )])
+        self.assertEqual(self.query('SELECT count(*) FROM jobs_calc'), [(3, )])  # view follows the new table
+
+    def test_reload_keeps_fts_index(self):
+        metadata = {'table_name': 'jobs', 'columns': [('name', 1, handbase_format.HANDBASE_TYPE_TEXT, 40)]}
+        self.assertEqual(csv2db.create_fts_index(self.filename, 'jobs', metadata), 'jobs_fts')
+        self.assertEqual(self.query("SELECT rowid FROM jobs_fts WHERE jobs_fts MATCH 'old'"), [(1, ), (2, )])
+        result = csv2db.load_streams(self.filename, [('jobs', rows_source([['name'], ['cherry tart'], ['apple pie']]))])
+        self.assertEqual(result, {'jobs': 2})
+        search = "SELECT jobs.name FROM jobs_fts JOIN jobs ON jobs.rowid = jobs_fts.rowid WHERE jobs_fts MATCH '%s'"
+        self.assertEqual(self.query(search % 'apple'), [('apple pie', )])
+        self.assertEqual(self.query(search % 'cherry'), [('cherry tart', )])
+        self.assertEqual(self.query(search % 'old'), [])
+        # triggers survived the swap, so later changes are indexed too
+        con = sqlite3.connect(self.filename)
+        con.execute("UPDATE jobs SET name = 'plum jam' WHERE name = 'apple pie'")
+        con.commit()
+        con.close()
+        self.assertEqual(self.query(search % 'plum'), [('plum jam', )])
+        self.assertEqual(self.query(search % 'apple'), [])
+
+    def test_failed_reload_keeps_table(self):
+        rows = [['name']] + [['new %d' % x] for x in range(2000)]
+        sources = [
+            ('jobs', rows_source(rows, fail_after=1500)),
+            ('other', rows_source([['name'], ['other 1']])),
+        ]
+        result = csv2db.load_streams(self.filename, sources, batch_size=100)
+        self.assertTrue(isinstance(result['jobs'], IOError), repr(result))
+        self.assertEqual(result['other'], 1)
+        self.assertEqual(self.query('SELECT name FROM jobs ORDER BY name'), [('old 1', ), ('old 2', )])
+        self.assertEqual(self.query('SELECT count(*) FROM jobs_calc'), [(2, )])
+        table_names = [row[0] for row in self.query("SELECT name FROM sqlite_master WHERE type = 'table' ORDER BY name")]
+        self.assertEqual(table_names, ['jobs', 'other'])  # no staging tables left behind
+
+
+if __name__ == '__main__':
+    unittest.main()
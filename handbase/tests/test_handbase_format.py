@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: us-ascii -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+#
+"""Tests for HanDBase CSV conversion, handbase_format.py
+
+    python -m unittest discover -s handbase/tests
+"""
+
+import datetime
+import io
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'csv'))
+import csv2db
+import db2csv
+import handbase_format
+
+
+# CSV as exported by HanDBase; Float fields Price set to 2 decimal places, Ratio to 4
+ROUND_TRIP_CSV = u'''Name,Count,Price,Ratio,Done,Due,At,Colour,Notes\r
+"a, \u20acb",3,1.50,32875945.3330,1,01/07/2024,12:34 pm,Red,x\r
+c,,-695333302.00,0.0000,0,No Date,No Time,No Value,\r
+d,7,2.00,-1.5000,1,12/31/2031,03:50 am,Blue,"two\r
+lines"\r
+'''.encode('cp1252')
+
+ROUND_TRIP_METADATA = {
+    'table_name': 'rt',
+    'columns': [
+        ('Name', 1, handbase_format.HANDBASE_TYPE_TEXT, 40),
+        ('Count', 2, handbase_format.HANDBASE_TYPE_INTEGER, 0),
+        ('Price', 3, handbase_format.HANDBASE_TYPE_FLOAT, 0),
+        ('Ratio', 3, handbase_format.HANDBASE_TYPE_FLOAT, 0),
+        ('Done', 6, handbase_format.HANDBASE_TYPE_CHECKBOX, 0),
+        ('Due', 10, handbase_format.HANDBASE_TYPE_DATE, 0),
+        ('At', 11, handbase_format.HANDBASE_TYPE_TIME, 0),
+        ('Colour', 4, handbase_format.HANDBASE_TYPE_POPUP, 0),
+        ('Notes', 14, handbase_format.HANDBASE_TYPE_NOTE, 0),
+    ],
+    'links': [],
+    'formulas': [],
+}
+
+
+class TestRoundTrip(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_csv2db_db2csv(self):
+        """HanDBase CSV -> csv2db (typed) -> db2csv with the same schema, is unchanged"""
+        connection_string = os.path.join(self.temp_dir, 'rt.sqlite3')
+
+        def get_source():
+            rows = handbase_format.csv_reader(io.BytesIO(ROUND_TRIP_CSV))
+            return handbase_format.meta2sql_ddl(ROUND_TRIP_METADATA), ROUND_TRIP_METADATA, rows
+        self.assertEqual(csv2db.load_streams(connection_string, [('rt', get_source)]), {'rt': 3})
+
+        metadata = dict(ROUND_TRIP_METADATA, decimal_places={'Price': 2, 'Ratio': 4})
+        filename = os.path.join(self.temp_dir, 'rt.csv')
+        db2csv.export_table(connection_string, 'rt', filename, metadata=metadata)
+        f = open(filename, 'rb')
+        result = f.read()
+        f.close()
+        self.assertEqual(result, ROUND_TRIP_CSV)
+
+
+class TestFormatters(unittest.TestCase):
+    def test_time_to_csv(self):
+        self.assertEqual(handbase_format.time_to_csv(datetime.time(15, 50, 12)), u'03:50 pm')
+        self.assertEqual(handbase_format.time_to_csv('15:50:12'), u'03:50 pm')
+        self.assertEqual(handbase_format.time_to_csv('00:05'), u'12:05 am')
+        self.assertEqual(handbase_format.time_to_csv('03:50 pm'), u'03:50 pm')
+        self.assertEqual(handbase_format.time_to_csv('12:00 AM'), u'12:00 am')
+        self.assertRaises(ValueError, handbase_format.time_to_csv, 'teatime')
+
+    def test_float_to_csv(self):
+        self.assertEqual(handbase_format.float_to_csv(-695333302.0), u'-695333302.0')  # digits are never dropped
+        self.assertEqual(handbase_format.float_to_csv(32875945.333), u'32875945.333')
+        self.assertEqual(handbase_format.float_to_csv(32875945.333, decimal_places=4), u'32875945.3330')
+        self.assertEqual(handbase_format.float_to_csv(2, decimal_places=0), u'2')
+
+
+if __name__ == '__main__':
+    unittest.main()
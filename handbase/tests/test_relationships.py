@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+# -*- coding: us-ascii -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+#
+"""Tests for loading a backup directory, relationships.py
+
+    python -m unittest discover -s handbase/tests
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'csv'))
+import handbase_format
+import relationships
+
+
+def write_backup_files(directory, filename, table_name):
+    """Write filename.PDB (for table_name) and filename.csv to directory"""
+    metadata = {'table_name': table_name, 'columns': [('Name', 1, handbase_format.HANDBASE_TYPE_TEXT, 40)]}
+    f = open(os.path.join(directory, filename + '.PDB'), 'wb')
+    f.write(handbase_format.metadata2pdb(metadata))
+    f.close()
+    f = open(os.path.join(directory, filename + '.csv'), 'wb')
+    f.write(b'Name\r\n' + filename.encode('cp1252') + b'\r\n')
+    f.close()
+
+
+class TestLoadBackup(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.temp_dir, 'backup.sqlite3')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_load(self):
+        write_backup_files(self.temp_dir, 'jobs', 'Jobs')
+        write_backup_files(self.temp_dir, 'clients', 'Clients')
+        self.assertEqual(relationships.load_backup(self.temp_dir, self.filename), {'Jobs': 1, 'Clients': 1})
+
+    def test_duplicate_table_name(self):
+        write_backup_files(self.temp_dir, 'jobs', 'Jobs')
+        write_backup_files(self.temp_dir, 'jobs_copy', 'Jobs')  # e.g. a copy made on the device
+        self.assertRaises(ValueError, relationships.load_backup, self.temp_dir, self.filename)
+        self.assertFalse(os.path.exists(self.filename))  # checked before loading anything
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+# -*- coding: us-ascii -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+#
+"""Tests for streamed downloads from a (fake, local) Handbase web server.
+
+    python -m unittest discover -s handbase/tests
+"""
+
+import errno
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+try:
+    # Py3
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    # Py2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'csv'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'web'))
+import device2db
+import remote
+
+remote.retries = 0
+remote.disable_logging = True
+remote.log.setLevel(100)  # quiet, failures are expected
+
+
+ROW_COUNT = 2000
+CSV_BODY = ('name,number\r\n' + ''.join('row %d,%d\r\n' % (x, x) for x in range(ROW_COUNT))).encode('cp1252')
+
+
+class FakeHandbaseHandler(BaseHTTPRequestHandler):
+    """export.csv is served with a correct Content-Length, but only
+    truncate_at bytes of the body are sent (at a row boundary) before the
+    connection is dropped.
+    With support_range, Range requests get a 206 that starts range_skew bytes
+    after the offset asked for, and only the first request is truncated.
+    The Range header of each request (or None) is appended to server.ranges.
+    """
+    truncate_at = None
+    support_range = False
+    range_skew = 0
+
+    def do_GET(self):
+        if not self.path.startswith('/export.csv'):
+            self.send_error(404)
+            return
+        body = CSV_BODY
+        range_header = self.headers.get('Range')
+        self.server.ranges.append(range_header)
+        if self.support_range and range_header:
+            start = int(range_header.split('=', 1)[1].rstrip('-')) + self.range_skew
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, len(body) - 1, len(body)))
+            body = body[start:]
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', 'text/csv')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.truncate_at is not None and not (self.support_range and len(self.server.ranges) > 1):
+            body = body[:self.truncate_at]
+        self.wfile.write(body)
+        self.wfile.flush()
+        self.close_connection = True
+
+    def log_message(self, *args):
+        pass
+
+
+def row_boundary(fraction):
+    """offset of the end of a row, roughly fraction of the way through CSV_BODY"""
+    return CSV_BODY.index(b'\r\n', int(len(CSV_BODY) * fraction)) + 2
+
+
+class FakeServerTestCase(unittest.TestCase):
+    truncate_at = None
+    support_range = False
+    range_skew = 0
+
+    def setUp(self):
+        handler = type('Handler', (FakeHandbaseHandler, ), {'truncate_at': self.truncate_at, 'support_range': self.support_range, 'range_skew': self.range_skew})
+        self.server = HTTPServer(('127.0.0.1', 0), handler)
+        self.server.ranges = []
+        self.server_url = 'http://127.0.0.1:%d/' % self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.temp_dir)
+
+
+class TestCompleteDownload(FakeServerTestCase):
+    def test_backup_device(self):
+        filename = os.path.join(self.temp_dir, 'backup.sqlite3')
+        result = device2db.backup_device(self.server_url, filename, dbnames=['generated'])
+        self.assertEqual(result, {'generated': ROW_COUNT})
+
+
+class TestTruncatedDownload(FakeServerTestCase):
+    truncate_at = row_boundary(2.0 / 3)
+
+    def test_open_db_stream(self):
+        dummy_filename, stream = remote.open_db_stream(self.server_url, 'generated')
+        try:
+            self.assertRaises(remote.IncompleteRead, stream.read)
+        finally:
+            stream.close()
+
+    def test_backup_device(self):
+        filename = os.path.join(self.temp_dir, 'backup.sqlite3')
+        result = device2db.backup_device(self.server_url, filename, dbnames=['generated'])
+        self.assertTrue(isinstance(result['generated'], remote.IncompleteRead), repr(result))
+
+    def test_iter_rows(self):
+        rows = remote.iter_rows(self.server_url, 'generated')
+        self.assertRaises(remote.IncompleteRead, list, rows)
+
+    def test_iter_rows_max_rows(self):
+        # stops before the drop, so is not an error
+        rows = list(remote.iter_rows(self.server_url, 'generated', max_rows=10))
+        self.assertEqual(len(rows), 10)
+
+
+class TestResumedDownload(FakeServerTestCase):
+    truncate_at = row_boundary(1.0 / 3)
+    support_range = True
+
+    def setUp(self):
+        FakeServerTestCase.setUp(self)
+        remote.retries = 2
+        remote.retry_backoff = 0.0
+        self.filename = os.path.join(self.temp_dir, 'generated.csv')
+
+    def tearDown(self):
+        remote.retries = 0
+        remote.retry_backoff = 1.0
+        FakeServerTestCase.tearDown(self)
+
+    def downloaded(self):
+        f = open(self.filename, 'rb')
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def test_resume(self):
+        self.assertEqual(remote.download_to_file(self.filename, self.server_url, 'generated'), len(CSV_BODY))
+        self.assertEqual(self.downloaded(), CSV_BODY)
+        self.assertEqual(self.server.ranges, [None, 'bytes=%d-' % self.truncate_at])
+
+    def test_wrong_offset_restarts(self):
+        self.server.RequestHandlerClass.range_skew = 5  # e.g. a proxy that ignores part of the Range
+        self.assertEqual(remote.download_to_file(self.filename, self.server_url, 'generated'), len(CSV_BODY))
+        self.assertEqual(self.downloaded(), CSV_BODY)
+        self.assertEqual(self.server.ranges, [None, 'bytes=%d-' % self.truncate_at, None])
+
+
+class TestIsRetryable(unittest.TestCase):
+    def test_local_errors(self):
+        for info in (OSError(errno.ENOSPC, 'No space left on device'), IOError(errno.EACCES, 'Permission denied')):
+            self.assertFalse(remote.is_retryable(info), repr(info))
+
+    def test_network_errors(self):
+        for info in (remote.IncompleteRead(b'', 10), remote.URLError('refused'), remote.socket.timeout('timed out'), remote.socket.error(errno.EHOSTUNREACH, 'No route to host')):
+            self.assertTrue(remote.is_retryable(info), repr(info))
+
+
+if __name__ == '__main__':
+    unittest.main()
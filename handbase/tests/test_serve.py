@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: us-ascii -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+#
+"""Tests for the read-only query server, serve.py
+
+    python -m unittest discover -s handbase/tests
+"""
+
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import unittest
+
+try:
+    # Py3
+    from urllib.error import HTTPError
+    from urllib.request import urlopen
+except ImportError:
+    # Py2
+    from urllib2 import HTTPError, urlopen
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'csv'))
+import serve
+
+
+class TestQueryServer(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.temp_dir, 'mirror.sqlite3')
+        con = sqlite3.connect(self.filename)
+        con.executescript('''
+            CREATE TABLE jobs (name STRING, photo BLOB);
+            CREATE VIEW jobs_calc AS SELECT name, length(name) AS name_length FROM jobs;
+            CREATE VIRTUAL TABLE jobs_fts USING fts5(name);
+            CREATE TABLE handbase_mirror_state (dbname TEXT PRIMARY KEY);
+            CREATE TABLE gone (name STRING);
+            CREATE VIEW broken AS SELECT name FROM gone;
+            DROP TABLE gone;
+        ''')
+        con.execute('INSERT INTO jobs VALUES (?, ?)', ('painting', sqlite3.Binary(b'\x00\xffPNG')))
+        con.commit()
+        con.close()
+        self.query_server = serve.QueryServer(self.filename, pool_size=1)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_table_names(self):
+        # no FTS shadow tables (jobs_fts_data, ...) or internal tables
+        self.assertEqual(self.query_server.table_names(), ['broken', 'jobs', 'jobs_calc'])
+
+    def test_blob_json(self):
+        content_type, body = self.query_server.response('/jobs.json', '')
+        rows = json.loads(body.decode('utf-8'))['rows']
+        self.assertEqual(rows, [{'name': 'painting', 'photo': 'AP9QTkc='}])
+
+    def test_blob_csv(self):
+        content_type, body = self.query_server.response('/jobs.csv', '')
+        self.assertEqual(body, b'name,photo\r\npainting,AP9QTkc=\r\n')
+
+    def test_sql_error_is_500(self):
+        handler = type('Handler', (serve.make_handler(self.query_server), ), {'log_message': lambda self, *args: None})
+        httpd = serve.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        thread = threading.Thread(target=httpd.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            url = 'http://127.0.0.1:%d/broken.json' % httpd.server_address[1]  # view on a dropped table
+            try:
+                urlopen(url, timeout=10)
+                self.fail('expected HTTP error')
+            except HTTPError as info:
+                self.assertEqual(info.code, 500)
+        finally:
+            httpd.shutdown()
+            httpd.server_close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# -*- coding: us-ascii -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+#
+"""Tests for cp1252 transcoding, transcode.py
+
+    python -m unittest discover -s handbase/tests
+"""
+
+import io
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'csv'))
+import transcode
+
+
+class TestTranscodeRows(unittest.TestCase):
+    def test_problem_locations(self):
+        """buffer offsets map back to the right (row, column), including after empty and transliterated cells"""
+        rows = [
+            [u'name', u'notes'],
+            [u'', u'\u2011a\U0001f600'],  # transliterated (shorter) then replaced
+            [u'\u4e2d', u''],
+            [u'fine', u'caf\xe9'],
+            [u'x', u'y\u4e2d\u4e2d'],
+        ]
+        new_rows, problems = transcode.transcode_rows(rows, first_row_number=10)
+        self.assertEqual(new_rows, [[u'name', u'notes'], [u'', u'-a?'], [u'?', u''], [u'fine', u'caf\xe9'], [u'x', u'y??']])
+        self.assertEqual(problems, [(11, 1, u'\U0001f600'), (12, 0, u'\u4e2d'), (14, 1, u'\u4e2d'), (14, 1, u'\u4e2d')])
+
+    def test_separator_in_data(self):
+        rows = [[u'a\x00b', u'\u4e2d'], [u'c', u'd']]
+        new_rows, problems = transcode.transcode_rows(rows)
+        self.assertEqual(new_rows, [[u'a\x00b', u'?'], [u'c', u'd']])
+        self.assertEqual(problems, [(0, 1, u'\u4e2d')])
+
+    def test_already_cp1252(self):
+        rows = [[u'caf\xe9', u'\u20ac5'], [u'', u'x']]
+        new_rows, problems = transcode.transcode_rows(rows)
+        self.assertEqual(new_rows, rows)
+        self.assertEqual(problems, [])
+
+
+class TestTranscodeCsv(unittest.TestCase):
+    def test_invalid_input_bytes(self):
+        """bad bytes part way through are reported, not a UnicodeDecodeError after a partial write"""
+        in_file = io.BytesIO(b'a,b\r\n' + b'1,2\r\n' * 5 + b'1,\xff\r\n' + b'3,4\r\n')
+        out_file = io.BytesIO()
+        header, row_count, problems = transcode.transcode_csv(in_file, out_file, in_encoding='utf-8', batch_size=2)
+        self.assertEqual(row_count, 7)
+        self.assertEqual(problems, [(6, 1, u'\ufffd')])
+        self.assertEqual(out_file.getvalue(), b'a,b\r\n' + b'1,2\r\n' * 5 + b'1,?\r\n' + b'3,4\r\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
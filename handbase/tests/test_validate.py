@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: us-ascii -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+#
+"""Tests for the pre-upload validator, validate.py
+
+    python -m unittest discover -s handbase/tests
+"""
+
+import datetime
+import decimal
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'csv'))
+import handbase_format
+import validate
+
+
+class TestNumberChecks(unittest.TestCase):
+    def test_integer_csv(self):
+        for value in ('5', '-5', '0', '1215752191'):
+            self.assertEqual(validate.check_integer(value, None, False), None, value)
+        for value in (' 5', '5 ', '1_000', '+5', '5.0', '1e3', 'nan', 'inf', '', '5\n'):
+            self.assertEqual(validate.check_integer(value, None, False), 'not an integer', value)
+        self.assertEqual(validate.check_integer('1215752192', None, False), 'integer out of range')
+
+    def test_integer_sql(self):
+        for value in (5, 5.0, decimal.Decimal('5'), '5'):
+            self.assertEqual(validate.check_integer(value, None, True), None, repr(value))
+        for value in (5.5, float('nan'), float('inf'), decimal.Decimal('NaN'), datetime.date(2024, 1, 7), None, b'5'):
+            self.assertEqual(validate.check_integer(value, None, True), 'not an integer', repr(value))
+
+    def test_float_csv(self):
+        for value in ('1.5', '-1.5', '2', '32875945.3330'):
+            self.assertEqual(validate.check_float(value, None, False), None, value)
+        for value in (' 1.5', '1_000.5', 'nan', 'inf', '-inf', '1e3', '.5', '1.', ''):
+            self.assertEqual(validate.check_float(value, None, False), 'not a number', value)
+
+    def test_float_sql(self):
+        for value in (1.5, 2, decimal.Decimal('1.5')):
+            self.assertEqual(validate.check_float(value, None, True), None, repr(value))
+        for value in (float('nan'), float('-inf'), datetime.date(2024, 1, 7), datetime.time(12, 34), None):
+            self.assertEqual(validate.check_float(value, None, True), 'not a number', repr(value))
+
+
+class TestValidateCsv(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def write_csv(self, data):
+        filename = os.path.join(self.temp_dir, 'jobs.csv')
+        f = open(filename, 'wb')
+        f.write(data)
+        f.close()
+        return filename
+
+    def test_undecodable_bytes(self):
+        """bytes the encoding can't decode are violations, not a UnicodeDecodeError"""
+        filename = self.write_csv(b'name,notes\r\nok,fine\r\nbad,\x81\r\nalso ok,x\r\n')
+        validator = validate.validate_csv(filename, encoding='cp1252')
+        self.assertEqual(validator.row_count, 3)
+        self.assertEqual(validator.problem_counts, {'notes': {'not cp1252': 1}})
+        self.assertEqual(validator.examples, [(2, 'notes', u'\ufffd', 'not cp1252')])
+
+        filename = self.write_csv(b'name\r\n\xff\r\n')
+        validator = validate.validate_csv(filename, encoding='utf-8')
+        self.assertEqual(validator.problem_counts, {'name': {'not cp1252': 1}})
+
+    def test_non_text_length(self):
+        """byte 2 of the field definition is only a length for Text fields"""
+        metadata = {
+            'table_name': 'jobs',
+            'columns': [
+                ('name', 1, handbase_format.HANDBASE_TYPE_TEXT, 4),
+                ('colour', 4, handbase_format.HANDBASE_TYPE_POPUP, 3),
+                ('client', 11, handbase_format.HANDBASE_TYPE_LINKED, 1),
+            ],
+        }
+        filename = self.write_csv(b'name,colour,client\r\nlong name,light blue,Acme Ltd\r\n')
+        validator = validate.validate_csv(filename, metadata=metadata)
+        self.assertEqual(validator.problem_counts, {'name': {'longer than 4 bytes': 1}})
+
+
+if __name__ == '__main__':
+    unittest.main()
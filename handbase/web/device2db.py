@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+# -*- coding: us-ascii -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+#
+"""Backup a Handbase (for Android) device, via the web server, straight into a SQLite3 database.
+
+One table per HanDBase database. The PDB is fetched for the schema
+(DDL) and the CSV export is streamed, parsed and inserted as it arrives.
+Several databases are downloaded at once, all inserts go through a
+single connection. No intermediate files.
+
+Equivalent to, but faster than:
+
+    remote.py --downloadall all
+    csv2db.py DBNAME.csv --pdb DBNAME.PDB -d backup.sqlite3  # for each database
+
+Can also run as a daemon, keeping a local mirror up to date by polling
+the device listing and re-downloading only databases that changed.
+"""
+
+import datetime
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'csv'))
+from cli import MyOptionParser
+import csv2db
+import handbase_format
+import remote
+
+log = remote.log
+
+__version__ = remote.__version__
+
+
+def device_source(server_url, dbname, encoding='cp1252'):
+    """Returns a csv2db.load_streams() source callable for database dbname on the device
+    """
+    def get_source():
+        ddl_sql = metadata = None
+        try:
+            metadata = remote.get_metadata(server_url, dbname)
+            ddl_sql = handbase_format.meta2sql_ddl(metadata, table_name=dbname)
+        except Exception as info:
+            # schema is nice to have, CSV alone is still a usable backup
+            log.warning('no schema for %r, using strings: %r', dbname, info)
+            ddl_sql = metadata = None
+
+        dummy_filename, response = remote.open_db_stream(server_url, dbname, dbtype=remote.DBTYPE_CSV)  # truncated transfer raises, not a short table
+
+        def rows():
+            try:
+                for row in handbase_format.csv_reader(response, encoding=encoding):
+                    yield row
+            finally:
+                response.close()
+        return ddl_sql, metadata, rows()
+    return get_source
+
+
+def backup_device(server_url, connection_string, dbnames=None, num_workers=4):
+    """Download databases from device into connection_string, one table per database.
+    dbnames - list of database (file) names, if None all shared databases are backed up
+    Returns dictionary, see csv2db.load_streams()
+    """
+    if dbnames is None:
+        dbnames = [row[3] for row in remote.get_db_list(server_url) if row[3] != remote.NOT_SHARED]
+    sources = [(dbname, device_source(server_url, dbname)) for dbname in dbnames]
+    return csv2db.load_streams(connection_string, sources, num_workers=num_workers)
+
+
+MIRROR_STATE_TABLE = handbase_format.INTERNAL_TABLE_PREFIX + 'mirror_state'
+
+
+class Mirror(object):
+    """Keep a local SQLite3 mirror of a device up to date, see run().
+
+    The device listing (one request) is polled, a database is re-downloaded
+    only when its listing entry (date/time, size, record count) changes.
+    Each database has its own poll interval; shortened when it changes,
+    lengthened when it does not. The listing is polled at the shortest
+    interval. When the device is unreachable polling backs off exponentially.
+
+    Listing state is kept in the mirror (MIRROR_STATE_TABLE), so a restart
+    does not re-download everything.
+    Change events are appended, as JSON lines, to events_filename.
+    """
+
+    def __init__(self, server_url, connection_string, events_filename=None, min_interval=30.0, max_interval=3600.0, num_workers=4):
+        self.server_url = server_url
+        self.connection_string = connection_string
+        self.events_filename = events_filename
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.num_workers = num_workers
+        self.intervals = {}  # dbname -> seconds
+        self.unreachable_delay = 0
+        self.listing = self.load_state()  # dbname -> (datetime, size, records)
+
+    def load_state(self):
+        con = csv2db.con2driver(self.connection_string).connect(self.connection_string)
+        try:
+            cur = con.cursor()
+            cur.execute('CREATE TABLE IF NOT EXISTS %s (dbname TEXT PRIMARY KEY, listing_datetime TEXT, size TEXT, records INTEGER, loaded_at TEXT)' % MIRROR_STATE_TABLE)
+            cur.execute('SELECT dbname, listing_datetime, size, records FROM %s' % MIRROR_STATE_TABLE)
+            result = dict((row[0], tuple(row[1:])) for row in cur.fetchall())
+            cur.close()
+            con.commit()
+        finally:
+            con.close()
+        return result
+
+    def save_state(self, loaded, removed):
+        con = csv2db.con2driver(self.connection_string).connect(self.connection_string)
+        try:
+            cur = con.cursor()
+            loaded_at = datetime.datetime.now().isoformat()
+            for dbname in loaded:
+                cur.execute('INSERT OR REPLACE INTO %s (dbname, listing_datetime, size, records, loaded_at) VALUES (?, ?, ?, ?, ?)' % MIRROR_STATE_TABLE,
+                            (dbname,) + tuple(self.listing[dbname]) + (loaded_at,))
+            for dbname in removed:
+                cur.execute('DELETE FROM %s WHERE dbname = ?' % MIRROR_STATE_TABLE, (dbname,))
+                cur.execute('DROP TABLE IF EXISTS "%s"' % dbname)
+            cur.close()
+            con.commit()
+        finally:
+            con.close()
+
+    def event(self, event_type, dbname=None, **kwargs):
+        log.info('%s %s %r', event_type, dbname or '', kwargs)
+        if not self.events_filename:
+            return
+        record = {'time': datetime.datetime.now().isoformat(), 'event': event_type, 'database': dbname}
+        record.update(kwargs)
+        f = open(self.events_filename, 'a')
+        try:
+            f.write(json.dumps(record) + '\n')  # one line per event, can be tailed
+        finally:
+            f.close()
+
+    def poll(self):
+        """Poll device once, apply changes to the mirror.
+        Returns number of seconds until the next poll.
+        """
+        try:
+            database_list = remote.get_db_list(self.server_url)
+        except Exception as info:
+            self.unreachable_delay = min(self.max_interval, (self.unreachable_delay * 2) or self.min_interval)
+            self.event('unreachable', error=repr(info), retry_seconds=self.unreachable_delay)
+            return self.unreachable_delay
+        self.unreachable_delay = 0
+
+        current = dict((row[3], tuple(row[:3])) for row in database_list if row[3] != remote.NOT_SHARED)
+        changed = [dbname for dbname in current if self.listing.get(dbname) != current[dbname]]
+        removed = [dbname for dbname in self.listing if dbname not in current]
+
+        loaded = []
+        if changed:
+            sources = [(dbname, device_source(self.server_url, dbname)) for dbname in changed]
+            results = csv2db.load_streams(self.connection_string, sources, num_workers=self.num_workers)
+            for dbname in changed:
+                row_count = results.get(dbname)
+                if isinstance(row_count, Exception) or row_count is None:
+                    self.event('error', dbname, error=repr(row_count))
+                    continue  # listing not updated, so will be retried next poll
+                self.listing[dbname] = current[dbname]
+                loaded.append(dbname)
+                self.event('changed', dbname, rows=row_count, listing_datetime=current[dbname][0])
+        for dbname in removed:
+            del self.listing[dbname]
+            self.intervals.pop(dbname, None)
+            self.event('removed', dbname)
+        if loaded or removed:
+            self.save_state(loaded, removed)
+
+        for dbname in current:
+            interval = self.intervals.get(dbname, self.min_interval)
+            if dbname in changed:
+                interval = max(self.min_interval, interval / 2)
+            else:
+                interval = min(self.max_interval, interval * 1.5)
+            self.intervals[dbname] = interval
+        if not self.intervals:
+            return self.max_interval
+        return min(self.intervals.values())
+
+    def run(self, once=False):
+        self.event('started', server_url=self.server_url)
+        while True:
+            delay = self.poll()
+            if once:
+                break
+            log.debug('next poll in %.1f seconds', delay)
+            time.sleep(delay)
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+
+    usage = "usage: %prog [options] [dbname ...]"
+    description = '''Backup HanDBase web server databases into a single SQLite3 database'''
+    example_usage = '''
+Examples:
+
+    %prog -d backup.sqlite3  # all shared databases
+    %prog -d backup.sqlite3 mydb otherdb  # only named databases
+    %prog -d mirror.sqlite3 --daemon --events changes.log  # keep mirror up to date
+'''
+    parser = MyOptionParser(usage=usage, version="%%prog %s" % __version__, description=description, epilog=example_usage)
+    parser.add_option("-d", "--dbname", help="SQL (SQLite3) Database name to backup into")
+    parser.add_option("--url", help="Specify server URL, if not set checks HANDBASE_URL os env, defaults to http://localhost:8000")
+    parser.add_option("-j", "--jobs", help="Number of databases to download at once, default %default", type="int", default=4)
+    parser.add_option("--daemon", help="Keep polling device, updating changed databases", action="store_true")
+    parser.add_option("--events", help="Daemon: append change events (JSON lines) to this file")
+    parser.add_option("--min-interval", help="Daemon: shortest poll interval in seconds, default %default", type="float", default=30.0)
+    parser.add_option("--max-interval", help="Daemon: longest poll interval in seconds, default %default", type="float", default=3600.0)
+    parser.add_option("-v", "--verbose", help='Verbose', action="store_true")
+
+    (options, args) = parser.parse_args(argv[1:])
+    if not options.dbname:
+        parser.print_help()
+        print('\n MISSING SQLite3 database name')  # stderr?
+        return 1
+
+    verbose = options.verbose
+    if verbose:
+        print('Python %s on %s' % (sys.version.replace('\n', ' - '), sys.platform))
+
+    server_url = options.url or os.environ.get('HANDBASE_URL', 'http://localhost:8000')
+    print('Using server: %s' % server_url)
+
+    if options.daemon:
+        mirror = Mirror(server_url, options.dbname, events_filename=options.events, min_interval=options.min_interval, max_interval=options.max_interval, num_workers=options.jobs)
+        mirror.run()
+        return 0
+
+    start_time = time.time()
+    results = backup_device(server_url, options.dbname, dbnames=args or None, num_workers=options.jobs)
+    failures = 0
+    for table_name in sorted(results):
+        row_count = results[table_name]
+        if isinstance(row_count, Exception):
+            failures += 1
+            print('%30s FAILED %r' % (table_name, row_count))
+        else:
+            print('%30s %8d rows' % (table_name, row_count))
+    print('%d tables in %.2f seconds' % (len(results), time.time() - start_time))
+
+    if failures:
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
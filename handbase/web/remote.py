@@ -6,15 +6,29 @@
 
 """
 
+import csv
 import datetime
+import errno
+import io
 import logging
 import os
-from optparse import OptionParser
+import random
+import re
+import socket
 import sys
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    # Py2
+    import Queue as queue
 
 try:
     # Py3
-    from urllib.error import HTTPError
+    from urllib.error import HTTPError, URLError
+    from http.client import HTTPException, IncompleteRead
     from urllib.request import build_opener, urlopen, urlretrieve, HTTPBasicAuthHandler, HTTPDigestAuthHandler, HTTPPasswordMgrWithDefaultRealm, Request
     from urllib.parse import parse_qs, quote_plus, urlencode, urljoin, urlparse
 except ImportError:
@@ -22,7 +36,14 @@ except ImportError:
     from cgi import parse_qs  # py2 (and <py3.8)
     from urlparse import urljoin, urlparse
     from urllib import quote_plus, urlencode, urlretrieve  #TODO is this in urllib2?
-    from urllib2 import build_opener, urlopen, HTTPBasicAuthHandler, HTTPDigestAuthHandler, HTTPPasswordMgrWithDefaultRealm, Request, HTTPError
+    from urllib2 import build_opener, urlopen, HTTPBasicAuthHandler, HTTPDigestAuthHandler, HTTPPasswordMgrWithDefaultRealm, Request, HTTPError, URLError
+    from httplib import HTTPException, IncompleteRead
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'csv'))
+from cli import MyOptionParser
+import handbase_format
+
+is_py3 = sys.version_info >= (3,)
 
 __version__ = '0.0.0'
 
@@ -39,6 +60,86 @@ formatter = logging.Formatter("logging %(process)d %(thread)d %(asctime)s - %(fi
 ch.setFormatter(formatter)
 log.addHandler(ch)
 
+# Network settings, seconds. Command line options override these
+connect_timeout = 15
+read_timeout = 60  # per socket read, not the whole transfer
+retries = 3  # only for idempotent (GET) requests
+retry_backoff = 1.0  # first retry delay, doubles each retry (with jitter)
+retry_backoff_max = 30.0
+download_chunk_size = 64 * 1024
+
+try:
+    # Py3, socket.error is OSError which would include local failures like a full disk
+    network_errors = (ConnectionError, socket.timeout, socket.gaierror, socket.herror)
+except NameError:
+    # Py2, socket.error is only raised by sockets
+    network_errors = (socket.error, socket.timeout)
+network_errnos = (errno.ENETDOWN, errno.ENETUNREACH, errno.EHOSTUNREACH, errno.ETIMEDOUT)
+content_range_re = re.compile(r'^bytes\s+(\d+)-')  # "bytes START-END/TOTAL"
+
+
+def set_read_timeout(response, timeout):
+    """urlopen() timeout applies to connecting (and is left on the socket),
+    switch an open response over to the (usually longer) read timeout.
+    Best effort, relies on http.client internals.
+    """
+    if timeout is None:
+        return
+    try:
+        sock = response.fp.raw._sock  # Py3
+    except AttributeError:
+        try:
+            sock = response.fp._sock  # Py2
+        except AttributeError:
+            return
+    try:
+        sock.settimeout(timeout)
+    except (AttributeError, socket.error):
+        pass
+
+def is_retryable(info):
+    """Is exception info (probably) transient, i.e. worth retrying?
+    Only network/HTTP failures, NOT local ones (e.g. ENOSPC writing the download).
+    """
+    if isinstance(info, HTTPError):
+        return info.code in (408, 429) or info.code >= 500
+    if isinstance(info, (URLError, HTTPException) + network_errors):
+        return True
+    return isinstance(info, socket.error) and getattr(info, 'errno', None) in network_errnos
+
+def retry_delay(attempt):
+    """Exponential backoff with jitter, attempt starts at 0"""
+    delay = min(retry_backoff_max, retry_backoff * (2 ** attempt))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+def with_retries(func, description, max_retries=None):
+    """Call func() (with no arguments), retrying transient failures.
+    ONLY use for idempotent requests.
+    """
+    if max_retries is None:
+        max_retries = retries
+    attempt = 0
+    while True:
+        try:
+            return func()
+        except Exception as info:
+            if attempt >= max_retries or not is_retryable(info):
+                raise
+            delay = retry_delay(attempt)
+            attempt += 1
+            log.warning('%s failed %r, retry %d/%d in %.1f seconds', description, info, attempt, max_retries, delay)
+            time.sleep(delay)
+
+def open_url(url, headers=None, max_retries=None):
+    """urlopen() GET with connect/read timeouts and retries (for connecting)
+    """
+    def get_response():
+        request = Request(url, headers=headers or {})
+        response = urlopen(request, timeout=connect_timeout)
+        set_read_timeout(response, read_timeout)
+        return response
+    return with_retries(get_response, url, max_retries=max_retries)
+
 
 def handbase_url_escape(in_str):
     # does not use urlencode() or quote_plus()
@@ -53,9 +154,14 @@ dbtype2file_extn = {
     DBTYPE_CSV: CSV_EXTENSION,
 }
 
-def get_db(server_url, dbname, dbtype=DBTYPE_CSV):
-    """Returns tuple of; filename, contents.
-    Where contents is bytes, csv will be cp1252 encoded
+NOT_SHARED = '!NOT_SHARED!'  # database name placeholder for databases that can not be downloaded
+
+def open_db(server_url, dbname, dbtype=DBTYPE_CSV, headers=None, max_retries=None):
+    """Returns tuple of; filename, response.
+    Where response is an open (file-like) http response, caller is
+    responsible for reading and closing it. Useful for streaming large
+    databases without holding the whole export in memory.
+    Connecting is retried, reading is not (see get_db()).
     """
     if not server_url.endswith('/'):
         server_url += '/'
@@ -73,29 +179,299 @@ def get_db(server_url, dbname, dbtype=DBTYPE_CSV):
         raise NotImplementedError('dbtype=%r' % dbtype)
 
     log.debug('about to get %r', get_db_url)
-    f = urlopen(get_db_url)
-    result = f.read()
+    f = open_url(get_db_url, headers=headers, max_retries=max_retries)
+    return (result_filename, f)
+
+class LengthCheckedReader(io.RawIOBase):
+    """Read-only raw stream over an HTTP response that raises IncompleteRead
+    if the body ends before Content-Length bytes have arrived.
+    response.read(amt) does not raise on a dropped connection, it just returns short,
+    which for CSV looks exactly like a (smaller) complete export.
+    Closing the stream closes the response.
+    """
+
+    def __init__(self, response):
+        self.response = response
+        self.expected_length = response.info().get('Content-Length')
+        if self.expected_length is not None:
+            self.expected_length = int(self.expected_length)
+        self.received_length = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        data = self.response.read(len(b))
+        if not data:
+            if self.expected_length is not None and self.received_length < self.expected_length:
+                raise IncompleteRead(b'', self.expected_length - self.received_length)
+            return 0
+        b[:len(data)] = data
+        self.received_length += len(data)
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            self.response.close()
+        io.RawIOBase.close(self)
+
+def open_db_stream(server_url, dbname, dbtype=DBTYPE_CSV, max_retries=None):
+    """Returns tuple of; filename, stream.
+    Like open_db() but the response body is a buffered binary stream
+    (e.g. for handbase_format.csv_reader()) that raises IncompleteRead
+    if the transfer is cut short, see LengthCheckedReader.
+    """
+    result_filename, response = open_db(server_url, dbname, dbtype=dbtype, max_retries=max_retries)
+    return (result_filename, io.BufferedReader(LengthCheckedReader(response), buffer_size=download_chunk_size))
+
+def get_db(server_url, dbname, dbtype=DBTYPE_CSV):
+    """Returns tuple of; filename, contents.
+    Where contents is bytes, csv will be cp1252 encoded
+    """
+    def fetch():
+        result_filename, f = open_db(server_url, dbname, dbtype=dbtype, max_retries=0)
+        try:
+            result = f.read()
+        finally:
+            f.close()
+        return (result_filename, result)
+    result_filename, result = with_retries(fetch, dbname)
     #print('result: %r' % result)
     #log.debug('Got %r', result)  ## verbose debug
     return (result_filename, result)
 
+def get_metadata(server_url, dbname):
+    """Returns handbase_format.extract_metadata() for database, as used for CSV export
+    """
+    dummy_filename, pdb_bytes = get_db(server_url, dbname, dbtype=DBTYPE_PDB)
+    return handbase_format.extract_metadata(pdb_bytes, include_unused=False, include_heading=True)  # they show up in CSV
+
+def column_indexes(header, column_names):
+    """Returns list of positions of column_names in header, raises ValueError for unknown columns"""
+    unknown_columns = [column_name for column_name in column_names if column_name not in header]
+    if unknown_columns:
+        raise ValueError('unknown column(s) %r, available %r' % (unknown_columns, header))
+    return [header.index(column_name) for column_name in column_names]
+
+def iter_csv_preview(response, columns=None, max_rows=None, encoding='cp1252'):
+    """Generator, returns header then (up to max_rows) rows from a (streaming) CSV response
+    (e.g. from open_db_stream()), only the named columns (list of names, in that order) if columns is set.
+    Stops reading as soon as max_rows rows have been seen, rest of the export is never transferred.
+    Closes response.
+    """
+    try:
+        rows = handbase_format.csv_reader(response, encoding=encoding)
+        try:
+            header = next(rows)
+        except StopIteration:
+            return  # empty export
+        indexes = None
+        if columns:
+            indexes = column_indexes(header, columns)
+            header = [header[index] for index in indexes]
+        yield header
+        if max_rows is not None and max_rows <= 0:
+            return
+        for row_count, row in enumerate(rows, 1):
+            if indexes is not None:
+                row = [row[index] for index in indexes]
+            yield row
+            if max_rows is not None and row_count >= max_rows:
+                break
+    finally:
+        response.close()
+
+def iter_rows(server_url, dbname, metadata=None, fetch_schema=False, as_dict=False, include_header=False, encoding='cp1252', columns=None, max_rows=None):
+    """Generator, returns typed rows from the CSV export of dbname as they arrive.
+    The first row is available before the download completes and memory use
+    does not depend on the size of the database.
+
+    metadata - optional schema (handbase_format.extract_metadata()) used for
+        types, see handbase_format.build_row_converter(). If not set and
+        fetch_schema is True, the PDB is downloaded first to get it.
+        Without a schema only NULL values are converted, to None.
+    as_dict - yield dictionaries keyed on column name, rather than lists
+    include_header - yield header (list of column names) first, ignored for as_dict
+    columns - optional list of column names, only these are returned (in this order)
+    max_rows - optional, stop (and close the connection) after this many rows
+
+    Example:
+
+        for row in iter_rows('http://phone:8000', 'jobs', fetch_schema=True, as_dict=True):
+            print(row)
+    """
+    if metadata is None and fetch_schema:
+        metadata = get_metadata(server_url, dbname)
+    dummy_filename, response = open_db_stream(server_url, dbname, dbtype=DBTYPE_CSV)
+    try:
+        rows = iter_csv_preview(response, columns=columns, max_rows=max_rows, encoding=encoding)
+        try:
+            header = next(rows)
+        except StopIteration:
+            return  # empty export
+        if metadata and columns:
+            column_metadata = dict((column[0], column) for column in metadata['columns'])
+            if [column_name for column_name in header if column_name not in column_metadata]:
+                metadata = None
+            else:
+                metadata = {'columns': [column_metadata[column_name] for column_name in header]}
+        if metadata and len(metadata['columns']) != len(header):
+            log.warning('schema for %r does not match CSV export, ignoring schema', dbname)
+            metadata = None
+        convert_row = handbase_format.build_row_converter(metadata)
+        if include_header and not as_dict:
+            yield header
+        for row in rows:
+            row = convert_row(row)
+            if as_dict:
+                row = dict(zip(header, row))
+            yield row
+    finally:
+        response.close()
+
+def download_ndjson(out_file, server_url, dbname, fetch_schema=True, encoding='cp1252', batch_size=1000, columns=None, max_rows=None):
+    """Stream CSV export of dbname to text file-like object out_file as newline delimited JSON,
+    see handbase_format.write_ndjson(). Typed when the schema (PDB) can be fetched,
+    otherwise strings (with NULLs). columns and max_rows, see iter_rows().
+    Returns number of rows written.
+    """
+    metadata = None
+    if fetch_schema:
+        try:
+            metadata = get_metadata(server_url, dbname)
+        except Exception as info:
+            log.warning('no schema for %r, using strings: %r', dbname, info)
+    rows = iter_rows(server_url, dbname, metadata=metadata, include_header=True, encoding=encoding, columns=columns, max_rows=max_rows)
+    try:
+        try:
+            header = next(rows)
+        except StopIteration:
+            return 0  # empty export
+        return handbase_format.write_ndjson(out_file, header, rows, batch_size=batch_size)
+    finally:
+        rows.close()
+
+def content_range_start(response):
+    """Returns first byte position of a 206 response (Content-Range header), or None if missing/unparsable"""
+    match = content_range_re.match(response.info().get('Content-Range') or '')
+    if match:
+        return int(match.group(1))
+    return None
+
+def download_to_file(filename, server_url, dbname, dbtype=DBTYPE_CSV):
+    """Stream database to filename, retrying transient failures.
+    If a transfer drops part way through, resumes with an HTTP Range request
+    when the server supports it (206 response starting at the Range requested),
+    otherwise starts over.
+    Returns number of bytes written.
+    """
+    offset = 0
+    attempt = 0
+    f = open(filename, 'wb')
+    try:
+        while True:
+            try:
+                headers = None
+                if offset:
+                    headers = {'Range': 'bytes=%d-' % offset}
+                try:
+                    dummy_filename, response = open_db(server_url, dbname, dbtype=dbtype, headers=headers, max_retries=0)
+                except HTTPError as info:
+                    if offset and info.code == 416:
+                        break  # Range Not Satisfiable, already have everything
+                    raise
+                try:
+                    if offset and response.getcode() == 206 and content_range_start(response) != offset:
+                        log.info('server resumed at %r not %d, restarting %r', response.info().get('Content-Range'), offset, dbname)
+                        offset = 0
+                        f.seek(0)
+                        f.truncate()
+                        continue  # request everything again, without a Range
+                    if offset and response.getcode() != 206:
+                        log.info('server does not support resume, restarting %r', dbname)
+                        offset = 0
+                        f.seek(0)
+                        f.truncate()
+                    expected_length = response.info().get('Content-Length')
+                    received_length = 0
+                    while True:
+                        chunk = response.read(download_chunk_size)
+                        if not chunk:
+                            break
+                        f.write(chunk)
+                        received_length += len(chunk)
+                        offset += len(chunk)
+                    if expected_length is not None and received_length < int(expected_length):
+                        # read(amt) does not raise on a dropped connection, it returns short
+                        raise IncompleteRead(b'', int(expected_length) - received_length)
+                finally:
+                    response.close()
+                break
+            except Exception as info:
+                if attempt >= retries or not is_retryable(info):
+                    raise
+                delay = retry_delay(attempt)
+                attempt += 1
+                log.warning('%s failed after %d bytes %r, retry %d/%d in %.1f seconds', dbname, offset, info, attempt, retries, delay)
+                time.sleep(delay)
+    finally:
+        f.close()
+    return offset
+
+def download_preview(filename, server_url, dbname, columns=None, max_rows=None, encoding='cp1252'):
+    """Save the first max_rows rows (and/or only columns) of the CSV export of dbname to filename,
+    in the same encoding. The connection is closed as soon as enough rows have arrived,
+    so is quick even for big databases. See iter_csv_preview().
+    Returns number of rows written (excluding header).
+    """
+    dummy_filename, response = open_db_stream(server_url, dbname, dbtype=DBTYPE_CSV)
+    rows = iter_csv_preview(response, columns=columns, max_rows=max_rows, encoding=encoding)
+    f = open(filename, 'wb')
+    row_count = -1  # header
+    try:
+        if is_py3:
+            out_text = io.TextIOWrapper(f, encoding=encoding, newline='')
+            out_csv = csv.writer(out_text)
+        else:
+            out_csv = csv.writer(f)
+        for row in rows:
+            if not is_py3:
+                row = [x.encode(encoding) for x in row]
+            out_csv.writerow(row)
+            row_count += 1
+        if is_py3:
+            out_text.flush()
+            out_text.detach()
+    finally:
+        rows.close()
+        f.close()
+    return max(0, row_count)
+
 def download_and_save_to_disk(filename, server_url, dbname, dbtype=DBTYPE_CSV):
-    returned_filename, filecontents = get_db(server_url, dbname, dbtype=dbtype)
-    #print((filename, returned_filename, filecontents))  # TODO save to disk
+    part_filename = filename + '.part'
+    try:
+        content_length = download_to_file(part_filename, server_url, dbname, dbtype=dbtype)
+    except:
+        if os.path.exists(part_filename):
+            os.remove(part_filename)
+        raise
     save_content = False
     if dbtype == DBTYPE_CSV:
-        if filecontents.strip():
+        f = open(part_filename, 'rb')
+        if f.read(1024).strip() or content_length > 1024:
             save_content = True
+        f.close()
     else:
-        if len(filecontents) > 30:
+        if content_length > 30:
             save_content = True
 
     if save_content:
-        f = open(filename, 'wb')  # user specified filename
-        f.write(filecontents)
-        f.close()
+        if os.path.exists(filename):
+            os.remove(filename)  # Windows rename() will not replace
+        os.rename(part_filename, filename)  # user specified filename
     else:
-        log.info('NOT saving, result empty/too-small %d bytes', len(filecontents))
+        os.remove(part_filename)
+        log.info('NOT saving, result empty/too-small %d bytes', content_length)
 
 def dumb_html_table_string_extract(line):
     # line needs to contain a single line, no newlines
@@ -103,7 +479,7 @@ def dumb_html_table_string_extract(line):
     # filename
     # Extract/handle: <td class="dlip"><a href="test.PDB" class="hb"><img src="dlpdb.gif" title="Download Database File to Desktop" border=0></a>
     if '"This database does not permit full access to sharing' in line:
-        return '!NOT_SHARED!'
+        return NOT_SHARED
     elif line.startswith('<td class="dlip"><a href="'):
         search_term = '<a href="'
         tmp_str = line[line.find(search_term) + len(search_term):]
@@ -195,8 +571,13 @@ def get_db_list(server_url):
 
     get_db_list_url = server_url  #+ 'export.csv?db=' + server_dbname
 
-    f = urlopen(get_db_list_url)
-    result = f.read()
+    def fetch():
+        f = open_url(get_db_list_url, max_retries=0)
+        try:
+            return f.read()
+        finally:
+            f.close()
+    result = with_retries(fetch, get_db_list_url)
     #log.debug('Got %r', result)
     result = result.decode('utf-8')
     table_list = dumb_handbase_parser_printer(result, print_to_stdout=False)
@@ -205,6 +586,9 @@ def get_db_list(server_url):
 POST = 'POST'
 
 def put_url(url, data, headers=None, verb=POST):
+    """Send data to url. Has timeouts but is NOT retried, uploads are not idempotent
+    (HanDBase appends, retrying a request that actually made it would duplicate rows).
+    """
     log.debug('put_url %s=%r', verb, url)
     response = None
     try:
@@ -213,7 +597,8 @@ def put_url(url, data, headers=None, verb=POST):
         else:
             request = Request(url, data=data)  # may not be needed
         request.get_method = lambda: verb
-        response = urlopen(request)
+        response = urlopen(request, timeout=connect_timeout)
+        set_read_timeout(response, read_timeout)
         url = response.geturl()  # WILL this work?
         code = response.getcode()
         #log("putURL [{}] response code:{}".format(url, code))
@@ -230,37 +615,29 @@ def put_url(url, data, headers=None, verb=POST):
 #
 # /csv_import.html - appletname
 # /applet_add.html
-def put_db(server_url, dbname, dbcontent, dbtype=DBTYPE_CSV):
-    """
-    dbname - name withOUT extension
-    dbcontent - database content in bytes. Either HanDBase v4.x PDB or CSV (in Windows-1252/cp1252 encoding)
-
-    TODO check header of dbcontents looks reasonable, e.g. PDB check
+def encode_db_upload(dbname, dbcontent, dbtype=DBTYPE_CSV):
+    """Returns tuple of; url path (relative to server url), body, headers.
+    Suitable for put_url(), see put_db().
+    Encoding is independent of the server so can be done once and sent to many devices.
     """
-    if not server_url.endswith('/'):
-        server_url += '/'
-
     post_dict = {
         'MAX_FILE_SIZE': b'3000000',
         'appletname': dbname.encode('cp1252'),
     }
 
     if dbtype == DBTYPE_CSV:
-        put_db_url = server_url + 'csv_import.html'
+        put_db_path = 'csv_import.html'
         post_dict['UpCSV'] = b'Add CSV Data'
         filename = dbname + CSV_EXTENSION
         file_content_type = b'text/csv'
     elif dbtype == DBTYPE_PDB:
-        put_db_url = server_url + 'applet_add.html'
+        put_db_path = 'applet_add.html'
         post_dict['UpPDB'] = b'Add File'
         filename = dbname + PDB_EXTENSION
         file_content_type = b'application/octet-stream'
     else:
         raise NotImplementedError('dbtype=%r' % dbtype)
 
-    #print((put_db_url, dbname, dbcontent, dbtype))
-    print((put_db_url, dbname, len(dbcontent), dbtype))
-
     bounder_mark = b'----------BOUNDARY_MARKER_GOES_HERE'
     body_list = []
     for key in post_dict:
@@ -283,14 +660,100 @@ def put_db(server_url, dbname, dbcontent, dbtype=DBTYPE_CSV):
     content_type = b'multipart/form-data; boundary=%s' % bounder_mark
 
     headers = {'content-type': content_type, 'content-length': len(body)}
+    return put_db_path, body, headers
+
+def put_db(server_url, dbname, dbcontent, dbtype=DBTYPE_CSV):
+    """
+    dbname - name withOUT extension
+    dbcontent - database content in bytes. Either HanDBase v4.x PDB or CSV (in Windows-1252/cp1252 encoding)
+
+    TODO check header of dbcontents looks reasonable, e.g. PDB check
+    """
+    if not server_url.endswith('/'):
+        server_url += '/'
+
+    put_db_path, body, headers = encode_db_upload(dbname, dbcontent, dbtype=dbtype)
+    put_db_url = server_url + put_db_path
+    #print((put_db_url, dbname, dbcontent, dbtype))
+    print((put_db_url, dbname, len(dbcontent), dbtype))
     log.debug('headers %r', headers)
     put_url(put_db_url, body, headers=headers, verb=POST)
 
+def is_safe_to_resend(info):
+    """Did an upload fail before anything was sent, i.e. could not connect?
+    Only then is it safe to retry, HanDBase appends so a resend of an upload
+    that (partially) arrived would duplicate records.
+    """
+    if isinstance(info, HTTPError):
+        return False
+    if isinstance(info, URLError):
+        return not isinstance(info.reason, socket.timeout)  # refused, unreachable, DNS, ...
+    return False
+
+def put_db_many(server_urls, dbname, dbcontent, dbtype=DBTYPE_CSV, max_workers=8, max_retries=None):
+    """Upload the same database to many devices at once.
+    dbcontent is encoded once, at most max_workers uploads are in flight.
+    Devices that could not be connected to are retried (with backoff),
+    other failures are not, see is_safe_to_resend().
+    Returns list (in server_urls order) of dictionaries:
+        {'url': str, 'ok': bool, 'seconds': float, 'attempts': int, 'error': exception or None}
+    """
+    if max_retries is None:
+        max_retries = retries
+    put_db_path, body, headers = encode_db_upload(dbname, dbcontent, dbtype=dbtype)
+    results = [{'url': server_url, 'ok': False, 'seconds': None, 'attempts': 0, 'error': None} for server_url in server_urls]
+
+    def upload(result):
+        server_url = result['url']
+        if not server_url.endswith('/'):
+            server_url += '/'
+        while True:
+            result['attempts'] += 1
+            start_time = time.time()
+            try:
+                put_url(server_url + put_db_path, body, headers=headers, verb=POST)
+                result['ok'] = True
+                result['error'] = None
+            except Exception as info:
+                result['error'] = info
+            result['seconds'] = time.time() - start_time
+            if result['ok'] or result['attempts'] > max_retries or not is_safe_to_resend(result['error']):
+                break
+            delay = retry_delay(result['attempts'] - 1)
+            log.warning('%s failed %r, retry %d/%d in %.1f seconds', result['url'], result['error'], result['attempts'], max_retries, delay)
+            time.sleep(delay)
+
+    work_queue = queue.Queue()
+    for result in results:
+        work_queue.put(result)
+
+    def worker():
+        while True:
+            try:
+                result = work_queue.get_nowait()
+            except queue.Empty:
+                break
+            upload(result)
+
+    workers = []
+    for dummy in range(max(1, min(max_workers, len(results)))):
+        t = threading.Thread(target=worker)
+        t.daemon = True
+        t.start()
+        workers.append(t)
+    for t in workers:
+        t.join()
+    return results
+
+def read_device_urls(filename):
+    """Returns list of urls from file, one per line. Blank lines and # comments ignored"""
+    f = open(filename)
+    try:
+        lines = [line.split('#', 1)[0].strip() for line in f]
+    finally:
+        f.close()
+    return [line for line in lines if line]
 
-class MyOptionParser(OptionParser):
-    def format_epilog(self, formatter):
-        # preserve newlines
-        return self.expand_prog_name(self.epilog)
 
 def filename2dbname(filename):
     dbname = filename.replace('\\', '/')
@@ -299,6 +762,13 @@ def filename2dbname(filename):
     dbname = dbname.rsplit('.', 1)[0]
     return dbname
 
+def set_network_options(options):
+    """Set module network settings from (optparse) command line options"""
+    global connect_timeout, read_timeout, retries
+    connect_timeout = options.timeout
+    read_timeout = options.read_timeout
+    retries = options.retries
+
 def main(argv=None):
     if argv is None:
         argv = sys.argv
@@ -311,10 +781,15 @@ Examples:
     %prog -u mydb.pdb  # upload HandDBase db, from file mydb.pdb
     %prog -u mydb.csv  # upload csv, from file mydb.csv - defaults database name
     %prog -u mydb.csv -d my_db_name  # upload csv, from file mydb.csv - into specified database name
+    %prog -u prices.csv --devices-file phones.txt -j 10  # upload to many devices at once
 
     %prog  mydb.pdb  # download HandDBase db, into file mydb.pdb - defaults database name to mydb
     %prog  mydb.csv  # download csv, into file mydb.csv - defaults database name to mydb
     %prog  mydb.csv -d my_db_name  # download csv, into file mydb.csv - from specified database name
+    %prog -d mydb --ndjson -  # download as newline delimited JSON, to stdout
+    %prog  mydb.csv --head 10 --columns name,price  # first 10 rows, two columns only
+
+    %prog --daemon --mirror mirror.sqlite3 --events changes.log  # keep local mirror up to date
 '''
     parser = MyOptionParser(usage=usage, version="%%prog %s" % __version__, description=description, epilog=example_usage)
     parser.add_option("-d", "--dbname", help="Database/table name, if not set defaults based on filename")
@@ -322,9 +797,25 @@ Examples:
     parser.add_option("-u", "--upload", help="Upload a file", action="store_true")
     parser.add_option("--url", help="Specify server URL, if not set checks HANDBASE_URL os env, defaults to http://localhost:8000")
     parser.add_option("--downloadall", help="download all in format [csv|pdb|all]")  # TODO restrict options here? CSV_EXTENSION or PDB_EXTENSION
+    parser.add_option("--ndjson", help="Download as (typed) newline delimited JSON into this file, - for stdout")
+    parser.add_option("--head", help="Download only the first N rows (CSV and --ndjson), stops the transfer early", type="int")
+    parser.add_option("--columns", help="Download only these comma separated columns (CSV and --ndjson)")
+    parser.add_option("--devices", help="Upload to many devices at once, comma separated server URLs")
+    parser.add_option("--devices-file", help="Upload to many devices at once, file with one server URL per line")
+    parser.add_option("-j", "--jobs", help="Maximum number of simultaneous uploads for --devices, default %default", type="int", default=8)
+    parser.add_option("--daemon", help="Keep a local SQLite3 mirror (--mirror) up to date, see device2db.py", action="store_true")
+    parser.add_option("--mirror", help="Daemon: SQLite3 database name to mirror into")
+    parser.add_option("--events", help="Daemon: append change events (JSON lines) to this file")
+    parser.add_option("--timeout", help="Connect timeout in seconds, default %default", type="float", default=connect_timeout)
+    parser.add_option("--read-timeout", help="Read timeout in seconds (between received data, not total), default %default", type="float", default=read_timeout)
+    parser.add_option("--retries", help="Retries for downloads/listing (uploads are never retried), default %default", type="int", default=retries)
     parser.add_option("-v", "--verbose", help='Verbose', action="store_true")
 
     (options, args) = parser.parse_args(argv[1:])
+    set_network_options(options)
+    columns = None
+    if options.columns:
+        columns = [x.strip() for x in options.columns.split(',') if x.strip()]
     if options.downloadall:
         downloadall = options.downloadall.upper()
         if downloadall not in (DBTYPE_PDB, DBTYPE_CSV, 'ALL'):
@@ -336,12 +827,22 @@ Examples:
         else:
             downloadall = (downloadall,)
 
-    if not (options.ls or options.downloadall) and not args:
+    if options.daemon and not options.mirror:
+        parser.print_help()
+        print('\n MISSING --mirror')  # stderr?
+        return 1
+
+    if not (options.ls or options.downloadall or options.daemon or (options.ndjson and options.dbname)) and not args:
         ## TODO consider using something line https://stackoverflow.com/a/664614 to add positional argument support
         parser.print_help()
         print('\n MISSING filename')  # stderr?
         return 1
 
+    ndjson_file = None
+    if options.ndjson == '-':
+        ndjson_file = sys.stdout
+        sys.stdout = sys.stderr  # keep progress messages out of the records
+
     verbose = options.verbose
     if verbose:
         print('Python %s on %s' % (sys.version.replace('\n', ' - '), sys.platform))
@@ -356,7 +857,12 @@ Examples:
     server_url = options.url or os.environ.get('HANDBASE_URL', 'http://localhost:8000')  # alternative idea; if not set, stop here
     print('Using server: %s' % server_url)
 
-    if options.ls:
+    if options.daemon:
+        import device2db  # needs csv2db, only import when needed
+        device2db.remote.set_network_options(options)  # when run as a script this module is __main__, not remote
+        device2db.Mirror(server_url, options.mirror, events_filename=options.events).run()
+        return 0
+    elif options.ls:
         database_list = get_db_list(server_url)
         database_list.sort()
         print('\t'.join(['datetime', '', 'size', 'row-count', 'filename_no_extension', '', '    database-name', ]))
@@ -372,12 +878,25 @@ Examples:
             database_list = get_db_list(server_url)
             for row in database_list:
                 database = row[3]
-                if database == '!NOT_SHARED!':  # FIXME use a constant, not a literal
+                if database == NOT_SHARED:
                     continue  # skip as this database/file is not shared
                 filename = database + dbtype2file_extn[dbtype]
                 print('Downloading %s ...' % database)
                 download_and_save_to_disk(filename, server_url, database, dbtype=dbtype)
         return 0
+    elif options.ndjson:
+        dbname = options.dbname or filename2dbname(args[0])
+        if ndjson_file is None:
+            ndjson_file = open(options.ndjson, 'w')
+        try:
+            row_count = download_ndjson(ndjson_file, server_url, dbname, columns=columns, max_rows=options.head)
+        finally:
+            if options.ndjson == '-':
+                sys.stdout = ndjson_file
+            else:
+                ndjson_file.close()
+        sys.stderr.write('%d rows written to %s\n' % (row_count, options.ndjson))
+        return 0
 
     filename = args[0]  # looks like case may is NOT be significant to server (for download or upload)
     print('filename: %r' % filename)
@@ -399,7 +918,34 @@ Examples:
         f = open(filename, 'rb')
         csv_bytes = f.read()
         f.close()
+        device_urls = []
+        if options.devices:
+            device_urls += [x.strip() for x in options.devices.split(',') if x.strip()]
+        if options.devices_file:
+            device_urls += read_device_urls(options.devices_file)
+        if device_urls:
+            start_time = time.time()
+            results = put_db_many(device_urls, dbname, csv_bytes, dbtype=dbtype, max_workers=options.jobs)
+            failures = 0
+            for result in results:
+                if result['ok']:
+                    status = 'OK'
+                else:
+                    failures += 1
+                    status = 'FAILED %r' % (result['error'],)
+                print('%-40s %7.2fs %d attempt(s) %s' % (result['url'], result['seconds'], result['attempts'], status))
+            print('%d devices, %d failed, %.2f seconds' % (len(results), failures, time.time() - start_time))
+            if failures:
+                return 1
+            return 0
         put_db(server_url, dbname, csv_bytes, dbtype=dbtype)
+    elif options.head is not None or columns:
+        if dbtype != DBTYPE_CSV:
+            print('\n --head and --columns are only supported for CSV')  # stderr?
+            return 1
+        start_time = time.time()
+        row_count = download_preview(filename, server_url, dbname, columns=columns, max_rows=options.head)
+        print('%d rows written to %s in %.2f seconds' % (row_count, filename, time.time() - start_time))
     else:  # download (default)
         download_and_save_to_disk(filename, server_url, dbname, dbtype=dbtype)
 